@@ -1,18 +1,25 @@
 from flask import Flask, jsonify, send_from_directory, request
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 import os
 import sys
 import logging
-import tempfile
-import shutil # Para borrar directorios completos
 
 # Configura el logger para la aplicación principal de Flask
-# Configuración global para todos los loggers
-logging.basicConfig(stream=sys.stderr, level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Nivel de log configurable con la variable de entorno LOG_LEVEL (INFO por defecto)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 app_logger = logging.getLogger('flask_app_main')
-app_logger.setLevel(logging.DEBUG)
+app_logger.setLevel(LOG_LEVEL)
+# El handler se añade una sola vez aunque el módulo se reimporte; la configuración
+# global (logging.basicConfig) solo se hace al ejecutar app.py directamente
+if not app_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    app_logger.addHandler(handler)
+app_logger.propagate = False
 
 # --- INICIO DE LA MODIFICACIÓN (Mantener esta sección para asegurar el PATH) ---
 # Añadir la ruta de Homebrew de FFmpeg al PATH del entorno
@@ -26,14 +33,49 @@ if ffmpeg_path not in os.environ["PATH"]:
 # Importa el Blueprint dj_bp desde tu módulo dj.py
 try:
     # Importar las variables de carpeta desde dj.py para que app.py también las conozca
-    from dj import dj_bp, UPLOAD_FOLDER, MIX_OUTPUT_FOLDER, clear_temp_files
+    from dj import dj_bp, UPLOAD_FOLDER, MIX_OUTPUT_FOLDER, UploadRequest, clear_temp_files, \
+        acquire_single_process_lock
     app_logger.info("Blueprint 'dj' importado con éxito.")
 except ImportError as e:
     app_logger.critical(f"ERROR CRÍTICO: No se pudo importar el Blueprint 'dj' de dj.py: {e}")
     sys.exit(1) # Salir si no se puede importar el Blueprint principal
 
+# orjson (en Rust) serializa bastante más rápido que el módulo json estándar las listas de
+# pistas de /api/files. Es opcional: sin él se usa el proveedor JSON por defecto de Flask.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask basado en orjson (jsonify, request.get_json, flask.json)."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        # Los tipos que orjson no conoce (Decimal, objetos con __html__, ...) los resuelve Flask
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Directorio desde el que se sirve el frontend (calculado una sola vez al importar)
+_STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Creación de la instancia de la aplicación Flask
 app = Flask(__name__)
+# El modo debug de Werkzeug solo se activa explícitamente con FLASK_DEBUG=1
+app.debug = os.environ.get('FLASK_DEBUG') == '1'
+# Las subidas se escriben directamente en UPLOAD_FOLDER mientras se reciben (ver dj.UploadRequest)
+app.request_class = UploadRequest
+# Con USE_X_SENDFILE=1 las descargas las sirve el proxy (Apache mod_xsendfile, lighttpd o nginx
+# con X-Accel-Redirect mapeado) y Flask solo envía la cabecera X-Sendfile
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE') == '1'
+# Tamaño máximo de una petición (MB), configurable con MAX_UPLOAD_MB
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 1024)) * 1024 * 1024
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 CORS(app) # Habilita CORS para toda la aplicación
 
 # ====================================================================
@@ -52,8 +94,9 @@ app_logger.info("Blueprint 'dj_bp' registrado.")
 @app.route('/')
 def index():
     # Sirve el archivo index.html desde el mismo directorio donde reside app.py
-    # send_from_directory sirve el archivo desde ese directorio.
-    return send_from_directory(os.path.dirname(os.path.abspath(__file__)), 'index.html')
+    # conditional/etag permiten responder 304 a peticiones repetidas; el servidor WSGI
+    # envía el archivo con wsgi.file_wrapper (sendfile) cuando lo soporta.
+    return send_from_directory(_STATIC_DIR, 'index.html', conditional=True, etag=True, max_age=3600)
 
 # ====================================================================
 # Manejadores de errores globales para toda la aplicación
@@ -68,6 +111,11 @@ def method_not_allowed_error(error):
     app_logger.error(f"405 Method Not Allowed: Método {request.method} no permitido para {request.url}")
     return jsonify({'error': f'Método {request.method} no permitido para esta URL.'}), 405
 
+@app.errorhandler(413)
+def request_entity_too_large_error(error):
+    app_logger.error(f"413 Request Entity Too Large: {request.url}")
+    return jsonify({'error': 'El archivo es demasiado grande.'}), 413
+
 @app.errorhandler(Exception)
 def handle_unexpected_error(error):
     error_message = f"Un error inesperado ha ocurrido en la aplicación principal: {str(error)}"
@@ -76,15 +124,23 @@ def handle_unexpected_error(error):
 
 
 if __name__ == '__main__':
+    # Configuración global para el resto de loggers (Werkzeug, librerías)
+    logging.basicConfig(stream=sys.stderr, level=LOG_LEVEL, format=LOG_FORMAT)
+
     # Configuración de host y puerto
     host = os.environ.get('FLASK_HOST', '0.0.0.0')
     port = int(os.environ.get('FLASK_PORT', 5001)) # Puerto por defecto 5001
 
+    # El estado de dj.py vive en memoria: un único proceso servidor (ver dj.acquire_single_process_lock)
+    acquire_single_process_lock()
+
     # Asegúrate de que los directorios temporales existen al inicio
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     os.makedirs(MIX_OUTPUT_FOLDER, exist_ok=True)
 
     app_logger.info(f"Iniciando la aplicación Flask en http://{host}:{port}")
-    # Usar debug=True solo en desarrollo. En producción, desactívalo.
+    # Este es el servidor de desarrollo de Werkzeug (un solo proceso).
+    # En producción usar el punto de entrada de asgi.py (uvicorn con un único worker).
+    # El modo debug (FLASK_DEBUG=1) solo debe usarse en desarrollo.
     # El modo debug permite el auto-reloader y proporciona un depurador interactivo.
-    app.run(debug=True, host=host, port=port, use_reloader=False) # use_reloader=False para evitar doble ejecución con logging.basicConfig
\ No newline at end of file
+    app.run(debug=app.debug, host=host, port=port, use_reloader=False) # use_reloader=False para evitar doble ejecución con logging.basicConfig
\ No newline at end of file
@@ -2,19 +2,46 @@ import xml.etree.ElementTree as ET
 import os
 import sys
 import urllib.parse
+import urllib.request
 import logging
-import re # Para expresiones regulares en la limpieza de URL
-import xmltodict # Para parsear XML a diccionario de forma más sencilla
 import tempfile
+import functools
+import threading
+from collections import OrderedDict
 from pydub import AudioSegment # Usado solo para generar MP3s dummy en __main__
 
+# lxml (libxml2, en C) es bastante más rápido que xml.etree para bibliotecas grandes.
+# Si no está instalado se usa xml.etree.ElementTree como alternativa.
+try:
+    from lxml import etree as _lxml_etree
+    _XML_PARSE_ERRORS = (ET.ParseError, _lxml_etree.ParseError)
+    # Selecciona el propio elemento si es el <dict> de 'Tracks' (plist/dict/dict precedido por <key>Tracks</key>)
+    _TRACKS_DICT_XPATH = _lxml_etree.XPath(
+        "self::dict[parent::dict[parent::plist]][preceding-sibling::*[1][self::key][. = 'Tracks']]"
+    )
+except ImportError:
+    _lxml_etree = None
+    _XML_PARSE_ERRORS = (ET.ParseError,)
+    _TRACKS_DICT_XPATH = None
+
+# ada-url (parser WHATWG en C++) para las URLs 'file://' de 'Location'. Es opcional:
+# sin él se usa urllib.parse.urlsplit, con el mismo tratamiento del resultado.
+try:
+    from ada_url import URL as _AdaURL
+except ImportError:
+    _AdaURL = None
+
 # Configuración del logger para apple_music_integration
 apple_logger = logging.getLogger('apple_music_integration_module')
-apple_logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stderr)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-apple_logger.addHandler(handler)
+apple_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# El handler se añade una sola vez aunque el módulo se reimporte (recargas, tests)
+if not apple_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    apple_logger.addHandler(handler)
+# No propagar al logger raíz para no escribir cada línea dos veces
+apple_logger.propagate = False
 
 # --- INICIO DE LA MODIFICACIÓN (Añadir estas líneas para asegurar FFmpeg para pydub) ---
 # Establecer la ruta a los ejecutables de FFmpeg para pydub en este módulo también,
@@ -28,96 +55,304 @@ except Exception as e:
 # --- FIN DE LA MODIFICACIÓN ---
 
 
+# Se evalúa una sola vez al importar el módulo
+_IS_WIN32 = sys.platform == "win32"
+
+
+def _from_file_url(location_url: str) -> str:
+    """
+    Convierte una URL 'file:' en una ruta del sistema operativo. El parseo lo hace ada-url
+    (o urllib como alternativa) y la conversión a ruta urllib.request.url2pathname, que
+    decodifica los %XX y, en Windows, resuelve la unidad ('/C:/...') y las contrabarras.
+    """
+    if _AdaURL is not None:
+        url = _AdaURL(location_url)
+        host, pathname = url.hostname, url.pathname
+    else:
+        parts = urllib.parse.urlsplit(location_url)
+        host, pathname = parts.hostname or '', parts.path
+    # 'localhost' equivale a la máquina local; otro host es una ruta de red (UNC)
+    if host and host != 'localhost':
+        pathname = '//' + host + pathname
+    return urllib.request.url2pathname(pathname)
+
+@functools.lru_cache(maxsize=100_000)
 def normalize_filepath(location_url: str) -> str:
     """
     Normaliza una URL de localización de archivo de iTunes a una ruta de sistema de archivos local.
-    Maneja el esquema 'file:///' y la decodificación de URL.
+    Maneja el esquema 'file://' y la decodificación de URL.
     """
     if not location_url:
         return ""
 
     try:
-        # Decodificar la URL
-        decoded_url = urllib.parse.unquote(location_url)
-        
-        # Eliminar el esquema 'file:///' o 'file://localhost/'
-        if decoded_url.startswith('file:///'):
-            path = decoded_url[len('file://'):] # Conservar un '/' para rutas absolutas
-        elif decoded_url.startswith('file://localhost/'):
-            path = decoded_url[len('file://localhost'):]
-        else:
-            path = decoded_url # Si no tiene esquema file://, asumir que ya es una ruta
-
-        # En Windows, convertir las barras si es necesario y manejar la unidad
-        if sys.platform == "win32":
-            # Si la ruta comienza con una barra y una letra de unidad (ej. /C:/), quitar la barra inicial
-            if re.match(r'^/[a-zA-Z]:/', path):
-                path = path[1:]
-            path = path.replace('/', '\\') # Convertir barras a contrabarras
-
+        if location_url[:5].lower() == 'file:':
+            return _from_file_url(location_url)
+        # Si no tiene esquema file://, asumir que ya es una ruta (posiblemente codificada)
+        path = urllib.parse.unquote(location_url)
+        if _IS_WIN32:
+            path = path.replace('/', '\\')
         return path
     except Exception as e:
         apple_logger.error(f"Error normalizando la ruta de archivo '{location_url}': {e}")
         return ""
 
-def parse_itunes_xml(xml_filepath: str) -> list:
+# Campos que se extraen de cada pista del XML, en orden
+TRACK_FIELDS = (
+    'Track ID', 'Name', 'Artist', 'Album', 'Genre', 'Kind', 'Size',
+    'Total Time', # en milisegundos
+    'Disc Number', 'Disc Count', 'Track Number', 'Track Count', 'Year',
+    'Date Modified', 'Date Added', 'Bit Rate', 'Sample Rate', 'Play Count',
+    'Play Date UTC', 'Artwork Count', 'Persistent ID', 'Track Type', 'Location'
+)
+
+# Campos con valores muy repetidos entre pistas: se internan para compartir una sola copia de cada texto
+_INTERNED_FIELDS = ('Artist', 'Album', 'Genre', 'Kind', 'Track Type')
+
+# Valores de 'Kind' de las pistas de audio (iTunes los escribe en el idioma del sistema).
+# Las pistas con otro 'Kind' (vídeos, PDFs, etc.) se descartan al parsear, antes de construir
+# su diccionario o normalizar su ruta, y nunca llegan al análisis de audio.
+_AUDIO_KINDS = frozenset((
+    'MPEG audio file', 'AAC audio file', 'Purchased AAC audio file', 'Matched AAC audio file',
+    'Apple Music AAC audio file', 'Apple Lossless audio file', 'WAV audio file', 'AIFF audio file',
+    'Archivo de audio MPEG', 'Archivo de audio AAC', 'Archivo de audio AAC comprado',
+    'Archivo de audio AAC coincidente', 'Archivo de audio Apple Lossless',
+    'Archivo de audio WAV', 'Archivo de audio AIFF',
+))
+
+def _plist_value(elem):
     """
-    Parsea un archivo XML de la biblioteca de iTunes/Apple Music y extrae información de las pistas.
-    Retorna una lista de diccionarios, cada uno representando una pista.
+    Convierte un elemento de valor de un plist (<integer>, <string>, <date>, <true/>, ...)
+    a su equivalente en Python.
     """
-    apple_logger.info(f"Parseando archivo XML de iTunes: {xml_filepath}")
-    tracks_data = []
+    tag = elem.tag
+    if tag == 'integer':
+        return int(elem.text)
+    if tag == 'real':
+        return float(elem.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    return elem.text # <string>, <date> y el resto se devuelven como texto
+
+def _track_from_elem(track_elem):
+    """
+    Construye el diccionario de una pista a partir de su elemento <dict>,
+    recorriendo sus hijos por pares (<key>, valor).
+    Retorna None si la pista no es de audio (según su 'Kind').
+    """
+    track_info = {}
+    children = iter(track_elem)
+    for key_elem in children:
+        value_elem = next(children, None)
+        if value_elem is None:
+            break
+        track_info[key_elem.text] = _plist_value(value_elem)
+
+    # Las pistas sin 'Kind' se conservan: el análisis decidirá si el archivo es legible
+    kind = track_info.get('Kind')
+    if kind is not None and kind not in _AUDIO_KINDS:
+        return None
+
+    # 'Location' se devuelve sin normalizar: la normalizan parse_itunes_xml y stream_itunes_xml
+    track = {field: track_info.get(field) for field in TRACK_FIELDS}
+    for field in _INTERNED_FIELDS:
+        value = track[field]
+        if isinstance(value, str):
+            track[field] = sys.intern(value)
+    return track
+
+def _is_tracks_dict(elem) -> bool:
+    """
+    Indica si un elemento (lxml) es el <dict> de 'Tracks': hijo del dict raíz de <plist>
+    y precedido por <key>Tracks</key>. La comprobación es una única XPath precompilada (en C).
+    """
+    return bool(_TRACKS_DICT_XPATH(elem))
+
+def _iter_tracks_lxml(xml_filepath: str):
+    """
+    Recorre las pistas con lxml.etree.iterparse, escuchando solo el cierre de los <dict>.
+    Cada pista se libera (junto con las anteriores) en cuanto se ha procesado.
+    """
+    tracks_elem = None
+    context = _lxml_etree.iterparse(xml_filepath, events=('end',), tag='dict',
+                                    huge_tree=True, remove_blank_text=True)
+    for _, elem in context:
+        if elem is tracks_elem:
+            break # No hace falta seguir leyendo (Playlists, etc.)
+
+        parent = elem.getparent()
+        if tracks_elem is None:
+            if parent is None or not _is_tracks_dict(parent):
+                continue
+            tracks_elem = parent
+        elif parent is not tracks_elem:
+            continue
+
+        track = _track_from_elem(elem)
+        if track is not None:
+            yield track
+
+        # Liberar la pista ya procesada y todo lo anterior dentro de 'Tracks'
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del parent[0]
+    del context
+
+def _iter_tracks_etree(xml_filepath: str):
+    """
+    Alternativa con xml.etree.ElementTree.iterparse cuando lxml no está disponible.
+    """
+    # La estructura es plist (nivel 1) -> dict (nivel 2) -> dict de 'Tracks' (nivel 3)
+    # -> un <dict> por pista (nivel 4)
+    depth = 0
+    last_key = None
+    tracks_elem = None
+
+    for event, elem in ET.iterparse(xml_filepath, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 3 and elem.tag == 'dict' and last_key == 'Tracks':
+                tracks_elem = elem
+            continue
 
+        # Evento 'end'
+        if tracks_elem is None:
+            if depth == 3 and elem.tag == 'key':
+                last_key = elem.text
+        elif depth == 4 and elem.tag == 'dict':
+            track = _track_from_elem(elem)
+            if track is not None:
+                yield track
+            # Liberar la pista ya procesada (y su <key>) para mantener la memoria constante
+            tracks_elem.clear()
+        elif elem is tracks_elem:
+            break # No hace falta seguir leyendo (Playlists, etc.)
+        depth -= 1
+
+def _iter_raw_tracks(xml_filepath: str):
+    """
+    Recorre las pistas con el backend disponible (lxml o xml.etree), sin normalizar 'Location'.
+    """
+    iter_tracks = _iter_tracks_lxml if _lxml_etree is not None else _iter_tracks_etree
+    yield from iter_tracks(xml_filepath)
+
+def _iter_tracks_logged(xml_filepath: str):
+    """
+    Recorre las pistas en bruto (sin normalizar 'Location') registrando, en lugar de propagar,
+    los errores de lectura/parseo. Si el archivo no existe o el XML está mal formado,
+    simplemente deja de producir pistas.
+    """
     if not os.path.exists(xml_filepath):
         apple_logger.error(f"Archivo XML no encontrado: {xml_filepath}")
-        return []
+        return
 
     try:
-        # Usar xmltodict para una conversión más fácil a diccionario
-        with open(xml_filepath, 'r', encoding='utf-8') as f:
-            xml_dict = xmltodict.parse(f.read())
-
-        # Navegar a la sección de pistas (Track)
-        # La estructura suele ser plist -> dict -> dict (Tracks)
-        tracks_dict = xml_dict.get('plist', {}).get('dict', {}).get('dict', {}).get('Tracks', {})
-
-        for track_id, track_info in tracks_dict.items():
-            track = {
-                'Track ID': track_info.get('Track ID'),
-                'Name': track_info.get('Name'),
-                'Artist': track_info.get('Artist'),
-                'Album': track_info.get('Album'),
-                'Genre': track_info.get('Genre'),
-                'Kind': track_info.get('Kind'),
-                'Size': track_info.get('Size'),
-                'Total Time': track_info.get('Total Time'), # en milisegundos
-                'Disc Number': track_info.get('Disc Number'),
-                'Disc Count': track_info.get('Disc Count'),
-                'Track Number': track_info.get('Track Number'),
-                'Track Count': track_info.get('Track Count'),
-                'Year': track_info.get('Year'),
-                'Date Modified': track_info.get('Date Modified'),
-                'Date Added': track_info.get('Date Added'),
-                'Bit Rate': track_info.get('Bit Rate'),
-                'Sample Rate': track_info.get('Sample Rate'),
-                'Play Count': track_info.get('Play Count'),
-                'Play Date UTC': track_info.get('Play Date UTC'),
-                'Artwork Count': track_info.get('Artwork Count'),
-                'Persistent ID': track_info.get('Persistent ID'),
-                'Track Type': track_info.get('Track Type'),
-                'Location': normalize_filepath(track_info.get('Location')) # Normalizar la ruta del archivo
-            }
-            tracks_data.append(track)
-            apple_logger.debug(f"Pista encontrada: {track.get('Name')} - {track.get('Artist')} ({track.get('Location')})")
-
-    except ET.ParseError as pe:
+        yield from _iter_raw_tracks(xml_filepath)
+
+    except _XML_PARSE_ERRORS as pe:
         apple_logger.error(f"Error de parseo XML en '{xml_filepath}': {pe}")
     except Exception as e:
         apple_logger.error(f"Error inesperado al leer XML de iTunes '{xml_filepath}': {e}", exc_info=True)
-    
+
+# Caché LRU de resultados de parse_itunes_xml / stream_itunes_xml:
+# (ruta, mtime_ns, tamaño) o ('content', hash) -> lista de pistas
+_PARSE_CACHE_MAXSIZE = 8
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+def _parse_cache_key(xml_filepath: str, content_hash: str = None):
+    """Clave de caché de un XML, o None si el archivo no existe."""
+    if content_hash:
+        return ('content', content_hash)
+    try:
+        st = os.stat(xml_filepath)
+    except OSError:
+        return None
+    return (os.path.abspath(xml_filepath), st.st_mtime_ns, st.st_size)
+
+def _parse_cache_get(cache_key):
+    """Retorna copias de las pistas en caché para cache_key, o None."""
+    with _parse_cache_lock:
+        cached = _parse_cache.get(cache_key)
+        if cached is None:
+            return None
+        _parse_cache.move_to_end(cache_key)
+    # Copias, para que los cambios del llamador en las pistas no alteren la caché
+    return [dict(track) for track in cached]
+
+def _parse_cache_put(cache_key, tracks_data: list):
+    """Guarda tracks_data en la caché (el llamador no debe modificar después esa lista)."""
+    if not tracks_data:
+        return
+    with _parse_cache_lock:
+        _parse_cache[cache_key] = tracks_data
+        while len(_parse_cache) > _PARSE_CACHE_MAXSIZE:
+            _parse_cache.popitem(last=False)
+
+def parse_itunes_xml(xml_filepath: str, content_hash: str = None) -> list:
+    """
+    Parsea un archivo XML de la biblioteca de iTunes/Apple Music y extrae información de las pistas.
+    Retorna una lista de diccionarios, cada uno representando una pista.
+    El XML se recorre en streaming con iterparse (lxml si está disponible): cada pista se libera
+    en cuanto se procesa, por lo que la memoria no crece con el tamaño de la biblioteca.
+    Los resultados se guardan en caché por (ruta, mtime, tamaño): si el archivo no ha cambiado
+    no se vuelve a parsear. Si se indica content_hash (ej. el SHA-256 del archivo), la caché se
+    indexa por contenido, así que también acierta con una copia nueva del mismo XML
+    (por ejemplo, cada vez que se sube la misma biblioteca).
+    """
+    cache_key = _parse_cache_key(xml_filepath, content_hash)
+    if cache_key is None or not os.path.exists(xml_filepath):
+        apple_logger.error(f"Archivo XML no encontrado: {xml_filepath}")
+        return []
+
+    cached = _parse_cache_get(cache_key)
+    if cached is not None:
+        apple_logger.info(f"XML de iTunes sin cambios, usando {len(cached)} pistas en caché: {xml_filepath}")
+        return cached
+
+    apple_logger.info(f"Parseando archivo XML de iTunes: {xml_filepath}")
+    tracks_data = []
+    for track in _iter_tracks_logged(xml_filepath):
+        track['Location'] = normalize_filepath(track['Location']) # Normalizar la ruta del archivo
+        apple_logger.debug("Pista encontrada: %s - %s (%s)", track.get('Name'), track.get('Artist'), track['Location'])
+        tracks_data.append(track)
+
     apple_logger.info(f"Se encontraron {len(tracks_data)} pistas en el XML.")
+
+    _parse_cache_put(cache_key, [dict(track) for track in tracks_data])
     return tracks_data
 
+def stream_itunes_xml(xml_filepath: str, content_hash: str = None):
+    """
+    Variante en streaming de parse_itunes_xml: generador que devuelve cada pista (con 'Location'
+    ya normalizada) en cuanto se lee del XML, para que el consumidor pueda empezar a procesarlas
+    antes de que termine el parseo. Comparte la caché de parse_itunes_xml: si el XML ya está en
+    caché se devuelven sus pistas, y si se recorre entero queda guardado en ella.
+    Como parse_itunes_xml, registra los errores en lugar de propagarlos.
+    """
+    cache_key = _parse_cache_key(xml_filepath, content_hash)
+    if cache_key is None or not os.path.exists(xml_filepath):
+        apple_logger.error(f"Archivo XML no encontrado: {xml_filepath}")
+        return
+
+    cached = _parse_cache_get(cache_key)
+    if cached is not None:
+        apple_logger.info(f"XML de iTunes sin cambios, usando {len(cached)} pistas en caché: {xml_filepath}")
+        yield from cached
+        return
+
+    apple_logger.info(f"Parseando archivo XML de iTunes (streaming): {xml_filepath}")
+    tracks_data = []
+    for track in _iter_tracks_logged(xml_filepath):
+        track['Location'] = normalize_filepath(track['Location'])
+        tracks_data.append(dict(track))
+        yield track
+
+    apple_logger.info(f"Se encontraron {len(tracks_data)} pistas en el XML.")
+    _parse_cache_put(cache_key, tracks_data)
+
 if __name__ == '__main__':
     # --- PRUEBA DE FUNCIONALIDAD ---
     apple_logger.info("Iniciando prueba de apple_music_integration.py")
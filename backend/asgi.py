@@ -0,0 +1,25 @@
+"""
+Punto de entrada ASGI para producción.
+
+Envuelve la aplicación Flask (WSGI) con asgiref para servirla con Uvicorn y el bucle de
+eventos uvloop (ejecutar desde el directorio backend/):
+
+    uvicorn asgi:app --workers 1 --loop uvloop --http httptools
+
+Debe ser un único worker: las subidas, los análisis en curso y el progreso de la mezcla se
+guardan en la memoria del proceso (ver dj.py), y un segundo worker no arranca
+(dj.acquire_single_process_lock).
+El paralelismo de CPU lo dan los pools de procesos de audio_analysis y playlist_generation;
+los análisis y la mezcla corren en segundo plano, así que las peticiones responden enseguida.
+
+`python app.py` sigue arrancando el servidor de desarrollo de Werkzeug.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app
+from dj import acquire_single_process_lock
+
+# El estado de dj.py vive en memoria: un segundo worker falla al arrancar en vez de dividirlo
+acquire_single_process_lock()
+
+app = WsgiToAsgi(flask_app)
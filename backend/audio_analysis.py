@@ -1,13 +1,20 @@
 import librosa
 import librosa.display
 import numpy as np
-from pydub import AudioSegment
+from pydub import AudioSegment # Usado solo para generar el MP3 de prueba en __main__
 import os
 import tempfile
 import warnings
 import sys
 import logging
 import soundfile as sf # Para leer/escribir archivos de audio con librosa
+import multiprocessing
+import threading
+import types
+import functools
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, Future # Para analizar archivos en procesos aparte
+from concurrent.futures.process import BrokenProcessPool
 
 # --- INICIO DE LA MODIFICACIÓN (Añadir estas líneas) ---
 # Establecer la ruta a los ejecutables de FFmpeg para pydub
@@ -17,13 +24,24 @@ AudioSegment.ffmpeg = "/usr/local/bin/ffmpeg"
 AudioSegment.ffprobe = "/usr/local/bin/ffprobe"
 # --- FIN DE LA MODIFICACIÓN ---
 
+# pyacoustid (Chromaprint) para identificar el mismo audio aunque se suba con otro nombre.
+# Es opcional (necesita libchromaprint o fpcalc): sin él no se calculan huellas de audio.
+try:
+    import acoustid
+except ImportError:
+    acoustid = None
+
 # Configuración del logger para audio_analysis
 audio_logger = logging.getLogger('audio_analysis_module')
-audio_logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stderr)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-audio_logger.addHandler(handler)
+audio_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# El handler se añade una sola vez aunque el módulo se reimporte (recargas, tests)
+if not audio_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    audio_logger.addHandler(handler)
+# No propagar al logger raíz para no escribir cada línea dos veces
+audio_logger.propagate = False
 
 # Suprimir advertencias de Librosa que no afectan el análisis
 warnings.filterwarnings('ignore', category=UserWarning, module='librosa')
@@ -31,7 +49,8 @@ warnings.filterwarnings('ignore', message='Deprecated API: librosa.core.frames_t
 
 # Mapeo de claves musicales a notación Camelot
 # Esto debe ser consistente con playlist_generation.py
-KEY_TO_CAMELOT = {
+# Se expone como un mapeo de solo lectura: es una constante del módulo.
+KEY_TO_CAMELOT = types.MappingProxyType({
     'C': '8B', 'C#': '3B', 'Db': '3B', 'D': '10B', 'D#': '5B', 'Eb': '5B',
     'E': '12B', 'F': '7B', 'F#': '2B', 'Gb': '2B', 'G': '9B', 'G#': '4B',
     'Ab': '4B', 'A': '11B', 'A#': '6B', 'Bb': '6B', 'B': '1B',
@@ -39,7 +58,136 @@ KEY_TO_CAMELOT = {
     'Cm': '5A', 'C#m': '12A', 'Dbm': '12A', 'Dm': '7A', 'D#m': '2A', 'Ebm': '2A',
     'Em': '9A', 'Fm': '4A', 'F#m': '11A', 'Gbm': '11A', 'Gm': '6A', 'G#m': '1A',
     'Abm': '1A', 'Am': '8A', 'A#m': '3A', 'Bbm': '3A', 'Bm': '10A'
-}
+})
+
+# Nombres de las 12 clases de altura (0 = C) tal y como los usa KEY_TO_CAMELOT
+_PITCH_CLASS_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+
+# Tablas precalculadas indexadas por (clase_de_altura * 2 + modo), con modo 0 = menor y 1 = mayor.
+# Evitan construir el nombre de la clave y buscarlo en el diccionario para cada pista.
+_KEY_NAME_BY_INDEX = tuple(name + ('' if mode else 'm') for name in _PITCH_CLASS_NAMES for mode in (0, 1))
+_CAMELOT_BY_INDEX = tuple(KEY_TO_CAMELOT[key_name] for key_name in _KEY_NAME_BY_INDEX)
+
+# Frecuencia de muestreo usada para el análisis. 22050 Hz basta para tempo, clave y energía
+# y reduce a la mitad el trabajo de las FFT frente a 44.1/48 kHz.
+ANALYSIS_SR = 22050
+
+# Duración (en segundos) de la ventana centrada que se analiza. BPM, clave y energía media
+# son estables a lo largo de una pista, así que no hace falta decodificar ni analizar el archivo entero.
+ANALYSIS_WINDOW_S = 30.0
+
+# Parámetros de la STFT para el cromagrama (detección de clave)
+CHROMA_N_FFT = 4096
+CHROMA_HOP_LENGTH = 2048
+
+class AudioAnalyzer:
+    """
+    Analizador reutilizable entre pistas. Reserva una sola vez los buffers de la STFT del
+    cromagrama (dimensionados para la ventana de análisis máxima) y los reutiliza en cada
+    llamada, en lugar de reservar y liberar varios MB por archivo.
+    """
+
+    def __init__(self, sr: int = ANALYSIS_SR, window_s: float = ANALYSIS_WINDOW_S,
+                 n_fft: int = CHROMA_N_FFT, hop_length: int = CHROMA_HOP_LENGTH):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        # Con center=True la STFT produce 1 + len(y) // hop_length frames
+        max_frames = 1 + int(np.ceil(sr * window_s)) // hop_length + 1
+        n_bins = 1 + n_fft // 2
+        self._stft_buf = np.empty((n_bins, max_frames), dtype=np.complex64, order='F')
+        self._power_buf = np.empty((n_bins, max_frames), dtype=np.float32, order='F')
+
+    def _chroma(self, y: np.ndarray, sr: int) -> np.ndarray:
+        """Cromagrama de y calculado sobre los buffers preasignados."""
+        n_frames = 1 + len(y) // self.hop_length
+        if n_frames > self._stft_buf.shape[1]:
+            # Señal más larga que la ventana prevista: se cae al camino que reserva memoria
+            return librosa.feature.chroma_stft(y=y, sr=sr, n_fft=self.n_fft, hop_length=self.hop_length)
+        stft = librosa.stft(y, n_fft=self.n_fft, hop_length=self.hop_length, out=self._stft_buf)
+        power = self._power_buf[:, :stft.shape[1]]
+        np.abs(stft, out=power)
+        np.square(power, out=power)
+        return librosa.feature.chroma_stft(S=power, sr=sr, n_fft=self.n_fft, hop_length=self.hop_length)
+
+    def analyze(self, filepath: str, temp_dir: str) -> dict:
+        """
+        Igual que analyze_audio, pero reutilizando los buffers de esta instancia.
+        Una instancia no debe usarse desde varios hilos a la vez.
+        """
+        audio_logger.info(f"Iniciando análisis de audio para: {filepath}")
+        audio_logger.debug(f"PATH de la aplicación: {os.environ.get('PATH')}") # <-- Línea de depuración para PATH
+        audio_logger.debug(f"Sys executable: {sys.executable}") # <-- Línea de depuración para ejecutable
+
+        analysis_results = {
+            'filename': os.path.basename(filepath),
+            'filepath': filepath,
+            'bpm': None,
+            'key': None,
+            'camelot_key': None,
+            'energy': None,
+            'duration': None,
+            'error_message': None
+        }
+
+        if not os.path.exists(filepath):
+            error_msg = f"Error: El archivo no existe en la ruta especificada: {filepath}"
+            audio_logger.error(error_msg)
+            analysis_results['error_message'] = error_msg
+            return analysis_results
+
+        try:
+            # La duración se obtiene de la cabecera del archivo completo
+            duration = librosa.get_duration(path=filepath)
+            analysis_results['duration'] = duration  # Duración en segundos
+
+            # librosa.load decodifica directamente (soundfile/audioread) a un array float32 mono,
+            # sin pasar por pydub ni por la conversión intermedia a enteros, y lo remuestrea
+            # a ANALYSIS_SR con un filtro polifásico. Solo se carga la ventana central de la pista.
+            window_offset = max(0.0, duration / 2 - ANALYSIS_WINDOW_S / 2)
+            y, sr = librosa.load(filepath, sr=ANALYSIS_SR, mono=True, dtype=np.float32, res_type='polyphase',
+                                 offset=window_offset, duration=ANALYSIS_WINDOW_S)
+
+            # 1. Análisis de BPM (Tempo)
+            onset_env = librosa.onset.onset_detect(y=y, sr=sr)
+            tempo, _ = librosa.beat.beat_track(onset_env=onset_env, sr=sr)
+            analysis_results['bpm'] = round(float(tempo), 2)
+
+            # 2. Análisis de Clave Musical
+            # Cromagrama a partir de una STFT (mucho más barato que HPSS + chroma_cqt y suficiente
+            # para estimar la clave de pistas masterizadas)
+            chroma = self._chroma(y, sr)
+            key_mode = librosa.feature.key_mode(chroma=chroma, sr=sr)
+        
+            # librosa 0.10.0+ devuelve 'key' y 'mode' por separado
+            # key_mode[0] es la clase de altura (0 = C), key_mode[1] es el modo (0 para menor, 1 para mayor)
+            key_index = int(key_mode[0]) * 2 + int(key_mode[1])
+            analysis_results['key'] = _KEY_NAME_BY_INDEX[key_index]
+            analysis_results['camelot_key'] = _CAMELOT_BY_INDEX[key_index]
+
+            # 3. Análisis de Energía (RMS)
+            # RMS (Root Mean Square) es una buena medida de la energía o volumen del audio
+            rms = librosa.feature.rms(y=y)[0]
+            energy = np.mean(rms)
+            analysis_results['energy'] = round(float(energy), 4)
+
+            audio_logger.info(f"Análisis completado para {os.path.basename(filepath)}: BPM={analysis_results['bpm']}, Key={analysis_results['key']} ({analysis_results['camelot_key']}), Energy={analysis_results['energy']}, Duration={analysis_results['duration']}s")
+
+        except Exception as e:
+            error_msg = f"Error al analizar el archivo de audio '{os.path.basename(filepath)}': {e}"
+            audio_logger.error(error_msg, exc_info=True)
+            analysis_results['error_message'] = error_msg
+
+        return analysis_results
+
+# Un analizador por hilo: los buffers no se pueden compartir entre llamadas concurrentes.
+# Cada proceso del pool de análisis tiene además el suyo propio.
+_thread_local = threading.local()
+
+def _get_default_analyzer() -> AudioAnalyzer:
+    analyzer = getattr(_thread_local, 'analyzer', None)
+    if analyzer is None:
+        analyzer = _thread_local.analyzer = AudioAnalyzer()
+    return analyzer
 
 def analyze_audio(filepath: str, temp_dir: str) -> dict:
     """
@@ -48,77 +196,128 @@ def analyze_audio(filepath: str, temp_dir: str) -> dict:
     temp_dir: Directorio temporal para guardar archivos intermedios si es necesario.
     Retorna un diccionario con los resultados del análisis.
     """
-    audio_logger.info(f"Iniciando análisis de audio para: {filepath}")
-    audio_logger.debug(f"PATH de la aplicación: {os.environ.get('PATH')}") # <-- Línea de depuración para PATH
-    audio_logger.debug(f"Sys executable: {sys.executable}") # <-- Línea de depuración para ejecutable
-
-    analysis_results = {
-        'filename': os.path.basename(filepath),
-        'filepath': filepath,
-        'bpm': None,
-        'key': None,
-        'camelot_key': None,
-        'energy': None,
-        'duration': None,
-        'error_message': None
-    }
-
-    if not os.path.exists(filepath):
-        error_msg = f"Error: El archivo no existe en la ruta especificada: {filepath}"
-        audio_logger.error(error_msg)
-        analysis_results['error_message'] = error_msg
-        return analysis_results
+    return _get_default_analyzer().analyze(filepath, temp_dir)
 
+def audio_fingerprint(filepath: str):
+    """
+    Huella Chromaprint del audio de un archivo (como 'chromaprint:<sha256 de la huella>'), que
+    coincide aunque el archivo se haya subido con otro nombre o con otras etiquetas.
+    Retorna None si pyacoustid no está disponible o la huella no se puede calcular.
+    """
+    if acoustid is None:
+        return None
     try:
-        # pydub requiere ffmpeg o avconv en el PATH, o especificado directamente como arriba
-        audio = AudioSegment.from_file(filepath)
-        analysis_results['duration'] = len(audio) / 1000.0  # Duración en segundos
+        _, fingerprint = acoustid.fingerprint_file(filepath)
+    except Exception as e:
+        audio_logger.warning(f"No se pudo calcular la huella Chromaprint de '{filepath}': {e}")
+        return None
+    if isinstance(fingerprint, str):
+        fingerprint = fingerprint.encode('ascii')
+    return 'chromaprint:' + hashlib.sha256(fingerprint).hexdigest()
 
-        # pydub.AudioSegment.get_array_of_samples() devuelve un array de enteros,
-        # para librosa se necesita float.
-        y = np.array(audio.get_array_of_samples()).astype(np.float32)
-        
-        # Si el audio es estéreo y pydub lo devuelve entrelazado, hay que separarlo
-        if audio.channels == 2:
-            # Dividir en canales izquierdo y derecho
-            y_left = y[0::2]
-            y_right = y[1::2]
-            # Podríamos promediar o usar un solo canal para el análisis
-            y = (y_left + y_right) / 2.0
-        
-        sr = audio.frame_rate
-
-        # 1. Análisis de BPM (Tempo)
-        onset_env = librosa.onset.onset_detect(y=y, sr=sr)
-        tempo, _ = librosa.beat.beat_track(onset_env=onset_env, sr=sr)
-        analysis_results['bpm'] = round(float(tempo), 2)
-
-        # 2. Análisis de Clave Musical
-        # Utilizar armónicos y percusivos para un mejor análisis de clave
-        y_harmonic, y_percussive = librosa.effects.hpss(y)
-        chroma = librosa.feature.chroma_cqt(y=y_harmonic, sr=sr)
-        key_mode = librosa.feature.key_mode(chroma=chroma, sr=sr)
-        
-        # librosa 0.10.0+ devuelve 'key' y 'mode' por separado
-        # key_mode[0] es la clave (ej. 'C'), key_mode[1] es el modo (0 para menor, 1 para mayor)
-        detected_key = librosa.key_to_note(key_mode[0], major=key_mode[1] == 1)
-        analysis_results['key'] = detected_key
-        analysis_results['camelot_key'] = KEY_TO_CAMELOT.get(detected_key, None)
+def _analyze_with_fingerprint(filepath: str, temp_dir: str) -> dict:
+    """analyze_audio más la huella Chromaprint del archivo (clave 'fingerprint'), en el mismo proceso del pool."""
+    result = analyze_audio(filepath, temp_dir)
+    result['fingerprint'] = audio_fingerprint(filepath) if not result.get('error_message') else None
+    return result
 
-        # 3. Análisis de Energía (RMS)
-        # RMS (Root Mean Square) es una buena medida de la energía o volumen del audio
-        rms = librosa.feature.rms(y=y)[0]
-        energy = np.mean(rms)
-        analysis_results['energy'] = round(float(energy), 4)
+# Pool de procesos compartido por todas las peticiones (se crea la primera vez que se usa).
+# El análisis es intensivo en CPU, así que los hilos no escalarían por el GIL.
+_executor = None
+_executor_lock = threading.Lock()
 
-        audio_logger.info(f"Análisis completado para {os.path.basename(filepath)}: BPM={analysis_results['bpm']}, Key={analysis_results['key']} ({analysis_results['camelot_key']}), Energy={analysis_results['energy']}, Duration={analysis_results['duration']}s")
+def warmup():
+    """
+    Prepara el análisis en el proceso actual: crea el AudioAnalyzer del hilo (buffers incluidos)
+    y ejecuta una vez cada etapa (cromagrama, onsets, beat tracking, RMS) sobre un segundo de
+    silencio. Así los imports perezosos de librosa, sus filtros y la compilación JIT (numba)
+    se pagan al arrancar y no en el primer archivo analizado. Cada proceso del pool la ejecuta al
+    arrancar (_init_worker); dj.py la llama además al importarse, y con 'forkserver' el servidor
+    importa el script principal, así que los procesos del pool parten ya de ese estado.
+    """
+    silence = np.zeros(ANALYSIS_SR, dtype=np.float32)
+    _get_default_analyzer()._chroma(silence, ANALYSIS_SR)
+    librosa.onset.onset_detect(y=silence, sr=ANALYSIS_SR)
+    librosa.beat.beat_track(y=silence, sr=ANALYSIS_SR)
+    librosa.feature.rms(y=silence)
 
-    except Exception as e:
-        error_msg = f"Error al analizar el archivo de audio '{os.path.basename(filepath)}': {e}"
-        audio_logger.error(error_msg, exc_info=True)
-        analysis_results['error_message'] = error_msg
+def _init_worker():
+    """Inicializador de cada proceso del pool de análisis."""
+    warmup()
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Retorna el pool de procesos de análisis, con un proceso por núcleo.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 'forkserver' en todas las plataformas que lo tienen (igual que playlist_generation.py):
+            # los hijos no heredan los hilos ni los locks del servidor (hacer fork de un proceso con
+            # hilos puede bloquearse) y, a diferencia de 'spawn', no reimportan numpy/librosa cada vez
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context('forkserver')
+            else:
+                mp_context = None # Windows: 'spawn'
+            max_workers = os.cpu_count() or 1
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                            initializer=_init_worker)
+            audio_logger.info(f"Pool de análisis creado con {max_workers} procesos.")
+        return _executor
+
+def _reset_executor(broken: ProcessPoolExecutor):
+    """
+    Descarta el pool si sigue siendo `broken` (un proceso murió, p. ej. por falta de memoria o
+    un fallo en una librería nativa): el siguiente get_executor() crea uno nuevo. Un
+    ProcessPoolExecutor roto rechaza todas las tareas, así que sin esto no se analizaría nada más.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not broken:
+            return # Otro hilo ya lo ha reemplazado
+        _executor = None
+    audio_logger.warning("El pool de análisis se ha roto (murió un proceso); se recreará.")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _reset_if_broken(executor: ProcessPoolExecutor, future: Future):
+    """Callback de los Futures del pool: si la tarea falló porque el pool se rompió, lo descarta."""
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        _reset_executor(executor)
+
+def _submit(fn, *args) -> Future:
+    """
+    Envía una tarea al pool. Si el pool está roto lo recrea y reintenta una vez; las tareas
+    que fallen más tarde por un pool roto también lo descartan para las siguientes.
+    """
+    executor = get_executor()
+    try:
+        future = executor.submit(fn, *args)
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        executor = get_executor()
+        future = executor.submit(fn, *args)
+    future.add_done_callback(functools.partial(_reset_if_broken, executor))
+    return future
 
-    return analysis_results
+def submit_analysis(filepath: str, temp_dir: str, fingerprint: bool = False) -> Future:
+    """
+    Lanza analyze_audio en el pool de procesos sin esperar al resultado.
+    Retorna un Future cuyo resultado es el diccionario de analyze_audio; con fingerprint=True
+    incluye además la huella de audio_fingerprint en la clave 'fingerprint'.
+    """
+    return _submit(_analyze_with_fingerprint if fingerprint else analyze_audio, filepath, temp_dir)
+
+def _analyze_paths(filepaths: list, temp_dir: str) -> list:
+    """Analiza un lote de archivos dentro de un proceso del pool."""
+    return [analyze_audio(filepath, temp_dir) for filepath in filepaths]
+
+def submit_analysis_batch(filepaths: list, temp_dir: str) -> Future:
+    """
+    Lanza el análisis de un lote de archivos como una sola tarea del pool (un único envío entre
+    procesos para todo el lote). El resultado del Future es la lista de resultados de
+    analyze_audio, en el mismo orden que filepaths.
+    """
+    return _submit(_analyze_paths, list(filepaths), temp_dir)
 
 if __name__ == '__main__':
     # --- PRUEBA DE FUNCIONALIDAD ---
@@ -4,19 +4,30 @@ import tempfile
 import time
 import json
 import logging
-import urllib.parse
-from flask import Blueprint, jsonify, request, send_file
+import functools
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import secrets
+from flask import Blueprint, Request, Response, json as flask_json, jsonify, request, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import shutil # Import shutil if you plan to use shutil.rmtree for directory removal, otherwise os.unlink and os.rmdir are used
+from werkzeug.security import safe_join
+import shutil # shutil.rmtree para borrar directorios completos (en segundo plano, ver _empty_directory)
 
 # Configuración del logger para este Blueprint
 dj_logger = logging.getLogger('dj_blueprint')
-dj_logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stderr)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-dj_logger.addHandler(handler)
+dj_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# El handler se añade una sola vez aunque el módulo se reimporte (recargas, tests)
+if not dj_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    dj_logger.addHandler(handler)
+# No propagar al logger raíz para no escribir cada línea dos veces
+dj_logger.propagate = False
 
 
 # Agrega el directorio actual (donde está dj.py y los otros módulos) a sys.path.
@@ -42,11 +53,44 @@ except ImportError as e:
     # No salir aquí para permitir que la aplicación se inicie, pero las funcionalidades
     # que dependen de estos módulos fallarán. Esto es útil para depuración.
 
+# Precalentar el análisis de audio una sola vez al importar el Blueprint (ver audio_analysis.warmup).
+# Se puede desactivar con DJ_WARMUP=0 (ej. en scripts que no analizan audio).
+if CUSTOM_MODULES_LOADED and os.environ.get('DJ_WARMUP', '1') != '0':
+    try:
+        _warmup_start = time.perf_counter()
+        audio_analysis.warmup()
+        dj_logger.info(f"Análisis de audio precalentado en {time.perf_counter() - _warmup_start:.2f} s.")
+    except Exception as e:
+        dj_logger.warning(f"No se pudo precalentar el análisis de audio: {e}")
+
+
+# Espacio libre mínimo (MB) para usar /dev/shm; por debajo se usa el directorio temporal en disco
+FAST_TMP_MIN_FREE_MB = int(os.environ.get('DJ_FAST_TMP_MIN_FREE_MB', 2048))
+
+def _fast_tmp() -> str:
+    """
+    Directorio base para los archivos de trabajo. Se usa /dev/shm (tmpfs, en RAM) si existe,
+    tiene permisos de escritura y suficiente espacio libre; en otro caso, el temporal del sistema.
+    DJ_TMP_DIR permite fijarlo explícitamente. En contenedores, /dev/shm suele ser pequeño
+    (64 MB en Docker) y hay que ampliarlo (--shm-size) para aprovecharlo.
+    """
+    configured = os.environ.get('DJ_TMP_DIR')
+    if configured:
+        return configured
+    shm = '/dev/shm'
+    try:
+        if os.path.isdir(shm) and os.access(shm, os.W_OK) \
+                and shutil.disk_usage(shm).free >= FAST_TMP_MIN_FREE_MB * 1024 * 1024:
+            return shm
+    except OSError:
+        pass
+    return tempfile.gettempdir()
 
 # Directorios temporales para las cargas y las mezclas
 # Es importante que estos directorios sean accesibles tanto para la carga como para el análisis
-UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'dj_uploads')
-MIX_OUTPUT_FOLDER = os.path.join(tempfile.gettempdir(), 'dj_mixes')
+_TMP_BASE = _fast_tmp()
+UPLOAD_FOLDER = os.path.join(_TMP_BASE, 'dj_uploads')
+MIX_OUTPUT_FOLDER = os.path.join(_TMP_BASE, 'dj_mixes')
 
 # Asegurarse de que los directorios existen
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -57,33 +101,280 @@ dj_logger.info(f"Directorio de mezclas: {MIX_OUTPUT_FOLDER}")
 
 # Almacén de archivos subidos y sus análisis
 # { 'unique_id': {'filename': '...', 'filepath': '...', 'bpm': '...', ...}}
-uploaded_files_analysis = {}
+# Es un LRU acotado a MAX_TRACKS pistas (ver _store_track) para que la memoria y el disco
+# no crezcan sin límite en sesiones largas.
+MAX_TRACKS = int(os.environ.get('DJ_MAX_TRACKS', 5000))
+uploaded_files_analysis = OrderedDict()
+
+# Estado de los análisis lanzados en segundo plano por /api/upload
+# { 'unique_id': {'status': 'processing' | 'completed' | 'error', 'filename': '...', 'error': ...}}
+# Una subida fusionada con otra pista del mismo audio lleva además 'duplicate_of': id de esa pista.
+analysis_tasks = {}
 
 # Estado global para el progreso de la mezcla
-mix_status = {
+MIX_STATUS_IDLE = {
     'status': 'idle', # 'idle', 'processing', 'completed', 'error'
     'progress': 0,    # 0-100
     'message': 'Listo para comenzar.',
     'output_file': None,
     'error_details': None
 }
+mix_status = dict(MIX_STATUS_IDLE)
+
+# Huellas de los archivos subidos con /api/upload, para detectar duplicados:
+# { 'huella': (unique_id, filepath) } y su inversa { unique_id: {'huella', ...} }.
+# Cada pista tiene la de su contenido ('sha256:...', al subirla) y, si pyacoustid está
+# disponible, la de su audio ('chromaprint:...', calculada en el pool junto con el análisis).
+_fingerprint_index = {}
+_fingerprint_by_id = {}
+
+# Los tres almacenes anteriores los modifican a la vez los hilos de las peticiones y los
+# callbacks del pool de análisis: todo acceso pasa por este lock (ver funciones _store_*).
+# Siempre se modifican en su sitio, nunca se reasignan, para que no haya referencias obsoletas.
+#
+# IMPORTANTE: este estado vive en la memoria de UN solo proceso. El servidor debe ejecutarse
+# con un único worker (uvicorn --workers 1, ver asgi.py): con varios, una subida, su estado
+# y la mezcla podrían caer en procesos distintos. El paralelismo de CPU lo dan los pools de
+# procesos de audio_analysis y playlist_generation. acquire_single_process_lock() lo impone.
+_state_lock = threading.RLock()
+
+# Archivo de bloqueo que garantiza un único proceso servidor por directorio de trabajo
+SERVER_LOCK_FILE = os.path.join(_TMP_BASE, 'dj_server.lock')
+_server_lock_fd = None
+
+def acquire_single_process_lock():
+    """
+    Toma un bloqueo exclusivo (flock) sobre SERVER_LOCK_FILE durante toda la vida del proceso.
+    Si otro proceso ya lo tiene (un segundo worker de uvicorn/gunicorn u otra instancia con el
+    mismo directorio de trabajo) lanza RuntimeError en vez de arrancar con el estado dividido.
+    Lo llaman los puntos de entrada (app.py y asgi.py), no la importación de este módulo, para
+    que los procesos hijos de los pools puedan importarlo. En plataformas sin fcntl no hace nada.
+    """
+    global _server_lock_fd
+    if _server_lock_fd is not None:
+        return
+    try:
+        import fcntl
+    except ImportError:
+        dj_logger.warning("fcntl no disponible: no se puede imponer un único proceso servidor.")
+        return
+    fd = os.open(SERVER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        dj_logger.critical(f"Otro proceso ya tiene el bloqueo {SERVER_LOCK_FILE}: "
+                           "el servidor debe ejecutarse con un único worker.")
+        raise RuntimeError("El servidor DJ debe ejecutarse en un único proceso (--workers 1).")
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _server_lock_fd = fd
+
+# Versión de uploaded_files_analysis: se incrementa con cada cambio y permite reutilizar
+# la respuesta serializada de /api/files (y su ETag) mientras no cambie
+_files_version = 0
+_files_response_cache = None # (versión, etag, cuerpo JSON)
+
+def _new_track_id() -> str:
+    """
+    ID único para una pista: marca de tiempo en nanosegundos (hex) más 32 bits aleatorios.
+    No colisiona entre peticiones simultáneas, se puede usar en URLs sin escapar
+    y los IDs se ordenan por momento de creación.
+    """
+    return f"{time.time_ns():x}_{secrets.token_hex(4)}"
+
+def _bump_files_version():
+    """Marca uploaded_files_analysis como modificado. Llamar con _state_lock tomado."""
+    global _files_version
+    _files_version += 1
+
+def _store_track(unique_id: str, track: dict):
+    """
+    Guarda (o reemplaza) una pista analizada en uploaded_files_analysis. Si se supera MAX_TRACKS,
+    descarta las pistas más antiguas y borra sus archivos subidos (los de UPLOAD_FOLDER;
+    los archivos de la biblioteca de iTunes nunca se tocan).
+    """
+    evicted = []
+    with _state_lock:
+        uploaded_files_analysis[unique_id] = track
+        uploaded_files_analysis.move_to_end(unique_id)
+        while len(uploaded_files_analysis) > MAX_TRACKS:
+            old_id, old_track = uploaded_files_analysis.popitem(last=False)
+            analysis_tasks.pop(old_id, None)
+            _forget_fingerprint(old_id)
+            evicted.append(old_track.get('filepath'))
+        _bump_files_version()
+
+    for filepath in evicted:
+        if filepath and os.path.dirname(os.path.abspath(filepath)) == UPLOAD_FOLDER:
+            try:
+                os.remove(filepath)
+            except OSError as e:
+                dj_logger.warning(f"No se pudo eliminar el archivo descartado '{filepath}': {e}")
+    if evicted:
+        dj_logger.info(f"Límite de {MAX_TRACKS} pistas alcanzado: {len(evicted)} pistas antiguas descartadas.")
+
+def _get_track(unique_id: str):
+    """Retorna la pista analizada con ese ID (y la marca como usada recientemente), o None."""
+    with _state_lock:
+        track = uploaded_files_analysis.get(unique_id)
+        if track is not None:
+            uploaded_files_analysis.move_to_end(unique_id)
+        return track
+
+def _store_task(unique_id: str, status: str, filename: str, error=None):
+    """Actualiza el estado de un análisis en segundo plano."""
+    with _state_lock:
+        analysis_tasks[unique_id] = {'status': status, 'filename': filename, 'error': error}
+
+def _store_mix_status(reset: bool = False, **changes):
+    """Actualiza mix_status (partiendo del estado inicial si reset=True) y retorna una copia."""
+    with _state_lock:
+        if reset:
+            mix_status.clear()
+            mix_status.update(MIX_STATUS_IDLE)
+        mix_status.update(changes)
+        return dict(mix_status)
+
+def _get_mix_status() -> dict:
+    """Retorna una copia de mix_status."""
+    with _state_lock:
+        return dict(mix_status)
+
+class UploadRequest(Request):
+    """
+    Request que escribe los archivos de los formularios multipart directamente en UPLOAD_FOLDER,
+    en lugar de en un SpooledTemporaryFile. Así guardar la subida (_save_upload) es un os.replace
+    dentro del mismo directorio, sin volver a copiar el archivo. Se registra en app.py
+    como app.request_class.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, prefix='.upload-', delete=False)
+        self.__dict__.setdefault('_upload_paths', []).append(stream.name)
+        return stream
+
+    def close(self):
+        super().close()
+        # Borrar los temporales que no se hayan movido a su destino (subidas rechazadas o fallidas)
+        for path in self.__dict__.get('_upload_paths', ()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                dj_logger.warning(f"No se pudo eliminar el archivo temporal de subida '{path}': {e}")
+
+def _save_upload(file, filepath: str):
+    """
+    Guarda un archivo subido en filepath. Si UploadRequest ya lo escribió en UPLOAD_FOLDER,
+    solo se renombra; en otro caso se copia con FileStorage.save.
+    """
+    stream_path = getattr(file.stream, 'name', None)
+    if isinstance(stream_path, str) and os.path.dirname(stream_path) == UPLOAD_FOLDER:
+        file.stream.close() # En Windows no se puede renombrar un archivo abierto
+        os.replace(stream_path, filepath)
+    else:
+        file.save(filepath)
+
+# Caché persistente de análisis, indexada por el SHA-256 del contenido del archivo:
+# volver a subir (o reimportar desde iTunes) un archivo ya analizado no repite el análisis.
+ANALYSIS_CACHE_DB = os.path.join(tempfile.gettempdir(), 'dj_analysis_cache.db')
+ANALYSIS_FIELDS = ('bpm', 'key', 'camelot_key', 'energy', 'duration')
+_analysis_cache_lock = threading.Lock()
+try:
+    _analysis_cache = sqlite3.connect(ANALYSIS_CACHE_DB, check_same_thread=False)
+    _analysis_cache.execute(
+        'CREATE TABLE IF NOT EXISTS analysis('
+        'hash TEXT PRIMARY KEY, bpm REAL, key TEXT, camelot_key TEXT, energy REAL, duration REAL)'
+    )
+    _analysis_cache.commit()
+    dj_logger.info(f"Caché de análisis: {ANALYSIS_CACHE_DB}")
+except sqlite3.Error as e:
+    _analysis_cache = None
+    dj_logger.warning(f"No se pudo abrir la caché de análisis '{ANALYSIS_CACHE_DB}': {e}. Se analizarán todos los archivos.")
+
+# Buffer de lectura de 1 MiB por hilo, reutilizado en todos los hashes de archivos
+_HASH_BUFFER_SIZE = 1 << 20
+_hash_tls = threading.local()
+
+def _hash_buffer() -> memoryview:
+    buffer = getattr(_hash_tls, 'buffer', None)
+    if buffer is None:
+        buffer = _hash_tls.buffer = memoryview(bytearray(_HASH_BUFFER_SIZE))
+    return buffer
+
+def _file_hash(path: str) -> str:
+    """SHA-256 del contenido de un archivo, leído por bloques sobre el buffer del hilo."""
+    digest = hashlib.sha256()
+    buffer = _hash_buffer()
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(buffer):
+            digest.update(buffer[:n])
+    return digest.hexdigest()
+
+def _cache_get(file_hash: str):
+    """Retorna el análisis guardado para file_hash ({campo: valor}) o None."""
+    if _analysis_cache is None or file_hash is None:
+        return None
+    try:
+        with _analysis_cache_lock:
+            row = _analysis_cache.execute(
+                'SELECT bpm, key, camelot_key, energy, duration FROM analysis WHERE hash = ?', (file_hash,)
+            ).fetchone()
+    except sqlite3.Error as e:
+        dj_logger.warning(f"Error leyendo la caché de análisis: {e}")
+        return None
+    return dict(zip(ANALYSIS_FIELDS, row)) if row else None
+
+def _cache_put(file_hash: str, analysis_result: dict):
+    """Guarda en la caché los campos de análisis de analysis_result."""
+    if _analysis_cache is None or file_hash is None:
+        return
+    try:
+        with _analysis_cache_lock:
+            _analysis_cache.execute(
+                'INSERT OR REPLACE INTO analysis(hash, bpm, key, camelot_key, energy, duration) VALUES (?, ?, ?, ?, ?, ?)',
+                (file_hash, *(analysis_result[field] for field in ANALYSIS_FIELDS))
+            )
+            _analysis_cache.commit()
+    except sqlite3.Error as e:
+        dj_logger.warning(f"Error escribiendo en la caché de análisis: {e}")
+
+def _try_file_hash(path: str):
+    """Como _file_hash, pero retorna None (sin caché) si el archivo no se puede leer."""
+    if _analysis_cache is None:
+        return None
+    try:
+        return _file_hash(path)
+    except OSError as e:
+        dj_logger.warning(f"No se pudo calcular el hash de '{path}': {e}")
+        return None
 
 # Crear un Blueprint
 dj_bp = Blueprint('dj', __name__)
 CORS(dj_bp) # Habilita CORS para este Blueprint
 
+def _empty_directory(folder: str):
+    """
+    Vacía un directorio sin esperar a borrar su contenido: lo renombra (operación atómica),
+    vuelve a crear el directorio vacío y borra el renombrado en un hilo en segundo plano.
+    """
+    trash = f"{folder}.trash.{time.time_ns()}"
+    os.rename(folder, trash)
+    os.makedirs(folder, exist_ok=True) # Volver a crear el directorio vacío
+    threading.Thread(target=shutil.rmtree, args=(trash,), kwargs={'ignore_errors': True},
+                     name='dj-clear-temp', daemon=True).start()
+
 # Función para limpiar archivos temporales
 def clear_temp_files():
-    global uploaded_files_analysis, mix_status
-    
     success = True
     messages = []
 
     # Limpiar directorio de subidas
     if os.path.exists(UPLOAD_FOLDER):
         try:
-            shutil.rmtree(UPLOAD_FOLDER)
-            os.makedirs(UPLOAD_FOLDER, exist_ok=True) # Volver a crear el directorio vacío
+            _empty_directory(UPLOAD_FOLDER)
             messages.append(f"Directorio de subidas '{UPLOAD_FOLDER}' limpiado.")
             dj_logger.info(messages[-1])
         except Exception as e:
@@ -94,8 +385,7 @@ def clear_temp_files():
     # Limpiar directorio de mezclas
     if os.path.exists(MIX_OUTPUT_FOLDER):
         try:
-            shutil.rmtree(MIX_OUTPUT_FOLDER)
-            os.makedirs(MIX_OUTPUT_FOLDER, exist_ok=True) # Volver a crear el directorio vacío
+            _empty_directory(MIX_OUTPUT_FOLDER)
             messages.append(f"Directorio de mezclas '{MIX_OUTPUT_FOLDER}' limpiado.")
             dj_logger.info(messages[-1])
         except Exception as e:
@@ -103,21 +393,127 @@ def clear_temp_files():
             dj_logger.error(messages[-1], exc_info=True)
             success = False
 
+    # Limpiar la caché de tempo de mixing_engine (pistas ya estiradas)
+    if CUSTOM_MODULES_LOADED and os.path.exists(mixing_engine.TEMPO_CACHE_DIR):
+        try:
+            _empty_directory(mixing_engine.TEMPO_CACHE_DIR)
+            messages.append(f"Caché de tempo '{mixing_engine.TEMPO_CACHE_DIR}' limpiada.")
+            dj_logger.info(messages[-1])
+        except Exception as e:
+            messages.append(f"Error al limpiar la caché de tempo '{mixing_engine.TEMPO_CACHE_DIR}': {e}")
+            dj_logger.error(messages[-1], exc_info=True)
+            success = False
+
     # Resetear el estado de la aplicación
-    uploaded_files_analysis = {}
-    mix_status = {
-        'status': 'idle',
-        'progress': 0,
-        'message': 'Listo para comenzar.',
-        'output_file': None,
-        'error_details': None
-    }
+    with _state_lock:
+        uploaded_files_analysis.clear()
+        _bump_files_version()
+        analysis_tasks.clear()
+        _fingerprint_index.clear()
+        _fingerprint_by_id.clear()
+        _store_mix_status(reset=True)
     messages.append("Estado de la aplicación reseteado.")
     dj_logger.info(messages[-1])
 
     return success, messages
 
 
+def _register_fingerprint(fingerprint, unique_id: str, filepath: str):
+    if fingerprint is None:
+        return
+    with _state_lock:
+        _fingerprint_index[fingerprint] = (unique_id, filepath)
+        _fingerprint_by_id.setdefault(unique_id, set()).add(fingerprint)
+
+def _forget_fingerprint(unique_id: str):
+    with _state_lock:
+        for fingerprint in _fingerprint_by_id.pop(unique_id, ()):
+            if _fingerprint_index.get(fingerprint, (None,))[0] == unique_id:
+                del _fingerprint_index[fingerprint]
+
+def _find_duplicate(fingerprint):
+    """
+    Busca una subida anterior con la misma huella que siga completada o en curso.
+    Retorna (unique_id, filepath, tarea, pista) o None.
+    """
+    if fingerprint is None:
+        return None
+    with _state_lock:
+        entry = _fingerprint_index.get(fingerprint)
+        if entry is None:
+            return None
+        unique_id, filepath = entry
+        task = analysis_tasks.get(unique_id)
+        if task is None or task['status'] == 'error':
+            return None
+        return unique_id, filepath, dict(task), uploaded_files_analysis.get(unique_id)
+
+def _store_uploaded_file(unique_id, filename, filepath, analysis_result):
+    """Almacena el análisis de un archivo subido con /api/upload y marca su tarea como completada."""
+    track = {
+        'id': unique_id,
+        'filename': filename,
+        'filepath': filepath, # Guarda la ruta completa aquí
+        'bpm': analysis_result['bpm'],
+        'key': analysis_result['key'],
+        'camelot_key': analysis_result['camelot_key'],
+        'energy': analysis_result['energy'],
+        'duration': analysis_result['duration']
+    }
+    _store_track(unique_id, track)
+    _store_task(unique_id, 'completed', filename)
+    dj_logger.info(f"Análisis completado para '{filename}': {track}")
+    return track
+
+def _merge_duplicate(unique_id, filename, filepath, file_hash, fingerprint) -> bool:
+    """
+    Si otra pista ya tiene la huella de audio `fingerprint`, fusiona con ella la subida
+    `unique_id`: borra su archivo, apunta su huella SHA-256 a la pista existente y deja su tarea
+    como alias (clave 'duplicate_of', ver get_upload_status). Retorna True si hubo fusión.
+    """
+    with _state_lock:
+        duplicate = _find_duplicate(fingerprint)
+        if duplicate is None or duplicate[0] == unique_id:
+            return False
+        duplicate_id, duplicate_path = duplicate[0], duplicate[1]
+        _forget_fingerprint(unique_id)
+        if file_hash:
+            _register_fingerprint(f'sha256:{file_hash}', duplicate_id, duplicate_path)
+        analysis_tasks[unique_id] = {'status': 'completed', 'filename': filename, 'error': None,
+                                     'duplicate_of': duplicate_id}
+    if os.path.abspath(duplicate_path) != os.path.abspath(filepath) and os.path.exists(filepath):
+        os.remove(filepath)
+    dj_logger.info(f"'{filename}' tiene el mismo audio que la pista {duplicate_id}; se fusiona con ella.")
+    return True
+
+def _on_analysis_done(unique_id, filename, filepath, file_hash, future):
+    """
+    Callback de los análisis lanzados por upload_file: guarda el resultado en
+    uploaded_files_analysis (y en la caché) o marca la tarea como fallida y borra el archivo subido.
+    Si la huella de audio calculada en el pool coincide con otra pista, se fusiona con ella.
+    """
+    try:
+        analysis_result = future.result()
+
+        if analysis_result['error_message']:
+            raise RuntimeError(f"Error en el análisis de audio: {analysis_result['error_message']}")
+
+        _cache_put(file_hash, analysis_result)
+        fingerprint = analysis_result.get('fingerprint')
+        if _merge_duplicate(unique_id, filename, filepath, file_hash, fingerprint):
+            return
+        # Almacenar el resultado del análisis con el ID único
+        _store_uploaded_file(unique_id, filename, filepath, analysis_result)
+        _register_fingerprint(fingerprint, unique_id, filepath)
+    except Exception as e:
+        dj_logger.error(f"Error al procesar el archivo '{filename}': {e}", exc_info=True)
+        _store_task(unique_id, 'error', filename, f'Error al procesar el archivo: {e}')
+        _forget_fingerprint(unique_id)
+        # Limpiar el archivo subido si falla el análisis
+        if os.path.exists(filepath):
+            os.remove(filepath)
+            dj_logger.warning(f"Archivo '{filename}' eliminado debido a error de procesamiento.")
+
 @dj_bp.route('/api/upload', methods=['POST'])
 def upload_file():
     if 'audio_file' not in request.files:
@@ -130,44 +526,93 @@ def upload_file():
     if file:
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        _save_upload(file, filepath)
         dj_logger.info(f"Archivo MP3 '{filename}' guardado en {filepath}")
 
         # Generar un ID único para el archivo subido
-        unique_id = str(time.time()).replace('.', '') # Timestamp como ID único
-        
-        try:
-            # Pasa el UPLOAD_FOLDER como temp_dir para analyze_audio
-            analysis_result = audio_analysis.analyze_audio(filepath, UPLOAD_FOLDER)
-            
-            if analysis_result['error_message']:
-                raise RuntimeError(f"Error en el análisis de audio: {analysis_result['error_message']}")
-
-            # Almacenar el resultado del análisis con el ID único
-            uploaded_files_analysis[unique_id] = {
-                'id': unique_id,
-                'filename': filename,
-                'filepath': filepath, # Guarda la ruta completa aquí
-                'bpm': analysis_result['bpm'],
-                'key': analysis_result['key'],
-                'camelot_key': analysis_result['camelot_key'],
-                'energy': analysis_result['energy'],
-                'duration': analysis_result['duration']
-            }
-            dj_logger.info(f"Análisis completado para '{filename}': {uploaded_files_analysis[unique_id]}")
+        unique_id = _new_track_id()
+
+        # Si el mismo archivo ya se subió (aunque sea con otro nombre), se reutiliza esa entrada
+        # en lugar de duplicarla y volver a analizarla. Aquí solo se compara el SHA-256 (barato);
+        # el mismo audio con otros bytes (etiquetas distintas) se detecta con la huella Chromaprint,
+        # que se calcula en el pool junto con el análisis (ver _on_analysis_done)
+        file_hash = _try_file_hash(filepath)
+        fingerprint = f'sha256:{file_hash}' if file_hash else None
+        duplicate = _find_duplicate(fingerprint)
+        if duplicate is not None:
+            duplicate_id, duplicate_path, task, track = duplicate
+            if os.path.abspath(duplicate_path) != os.path.abspath(filepath):
+                os.remove(filepath)
+            dj_logger.info(f"'{filename}' es un duplicado de la pista {duplicate_id}; se reutiliza su análisis.")
+            if task['status'] == 'completed' and track is not None:
+                return jsonify({
+                    'message': 'Archivo ya cargado y analizado previamente',
+                    'file_id': duplicate_id,
+                    'analysis': track
+                }), 200
+            return jsonify({
+                'message': 'Archivo ya cargado; análisis en curso',
+                'file_id': duplicate_id,
+                'task_id': duplicate_id
+            }), 202
+
+        # Si el contenido ya se analizó antes, se responde directamente con el análisis guardado
+        cached = _cache_get(file_hash)
+        if cached is not None:
+            track = _store_uploaded_file(unique_id, filename, filepath, cached)
+            _register_fingerprint(fingerprint, unique_id, filepath)
             return jsonify({
                 'message': 'Archivo cargado y analizado con éxito',
                 'file_id': unique_id,
-                'analysis': uploaded_files_analysis[unique_id]
+                'analysis': track
             }), 200
+
+        try:
+            # El análisis se ejecuta en el pool de procesos de audio_analysis para no bloquear
+            # el hilo de la petición; el cliente consulta /api/upload-status/<file_id>.
+            # Pasa el UPLOAD_FOLDER como temp_dir para analyze_audio
+            future = audio_analysis.submit_analysis(filepath, UPLOAD_FOLDER, fingerprint=True)
         except Exception as e:
-            dj_logger.error(f"Error al procesar el archivo '{filename}': {e}", exc_info=True)
-            # Limpiar el archivo subido si falla el análisis
+            dj_logger.error(f"Error al lanzar el análisis del archivo '{filename}': {e}", exc_info=True)
             if os.path.exists(filepath):
                 os.remove(filepath)
                 dj_logger.warning(f"Archivo '{filename}' eliminado debido a error de procesamiento.")
             return jsonify({'error': f'Error al procesar el archivo: {e}'}), 500
 
+        _store_task(unique_id, 'processing', filename)
+        _register_fingerprint(fingerprint, unique_id, filepath)
+        future.add_done_callback(functools.partial(_on_analysis_done, unique_id, filename, filepath, file_hash))
+        dj_logger.info(f"Análisis de '{filename}' encolado (ID: {unique_id}).")
+        return jsonify({
+            'message': 'Archivo cargado; análisis en curso',
+            'file_id': unique_id,
+            'task_id': unique_id
+        }), 202
+
+@dj_bp.route('/api/upload-status/<file_id>', methods=['GET'])
+def get_upload_status(file_id):
+    """Devuelve el estado del análisis de un archivo subido con /api/upload."""
+    with _state_lock:
+        task = analysis_tasks.get(file_id)
+        if task is None:
+            return jsonify({'error': 'ID de archivo no encontrado.'}), 404
+
+        # Una subida fusionada con otra pista del mismo audio (ver _merge_duplicate)
+        # informa del estado y el análisis de esa pista
+        track_id = task.get('duplicate_of', file_id)
+        if track_id != file_id:
+            task = analysis_tasks.get(track_id)
+            if task is None:
+                return jsonify({'error': 'ID de archivo no encontrado.'}), 404
+
+        response = {'file_id': track_id, **task}
+        if task['status'] == 'completed':
+            response['analysis'] = uploaded_files_analysis.get(track_id)
+    return jsonify(response), 200
+
+# Pistas por tarea del pool de análisis al importar un XML de iTunes
+XML_ANALYSIS_BATCH_SIZE = 4
+
 @dj_bp.route('/api/upload-xml', methods=['POST'])
 def upload_xml():
     if 'xml_file' not in request.files:
@@ -180,50 +625,94 @@ def upload_xml():
     if file:
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, filename) # Guardar XML en el mismo directorio temporal
-        file.save(filepath)
+        _save_upload(file, filepath)
         dj_logger.info(f"Archivo XML '{filename}' guardado en {filepath}")
 
         try:
             # Parsear el XML y extraer las pistas
             # Asume que normalize_filepath maneja la decodificación correctamente
-            itunes_tracks = apple_music_integration.parse_itunes_xml(filepath)
-            
-            if not itunes_tracks:
-                raise ValueError("No se encontraron pistas en el archivo XML o el formato es incorrecto.")
-
-            newly_processed_tracks = []
-            for track_data in itunes_tracks:
-                track_path = track_data.get('filepath')
-                if track_path and os.path.exists(track_path):
-                    # Generar un ID único para la pista
-                    unique_id = str(time.time()) + "_" + secure_filename(track_data['filename']) # Combinar timestamp y nombre de archivo para evitar colisiones simples
-                    # Normalizar el ID eliminando caracteres no deseados si existen del secure_filename
-                    unique_id = urllib.parse.quote_plus(unique_id).replace('.', '') # Asegura que sea seguro para usar como clave y elimina puntos
-
-                    # Realizar análisis de audio para cada pista
-                    dj_logger.info(f"Analizando pista de iTunes: {track_data.get('filename')} desde {track_path}")
-                    
-                    # Pasa el UPLOAD_FOLDER como temp_dir para analyze_audio
-                    analysis_result = audio_analysis.analyze_audio(track_path, UPLOAD_FOLDER)
-
-                    if analysis_result['error_message']:
-                        dj_logger.warning(f"Análisis fallido para {track_data.get('filename')}: {analysis_result['error_message']}")
-                        continue # Saltar esta pista si falla el análisis
-
-                    # Actualizar los datos de la pista con los resultados del análisis
-                    track_data.update({
-                        'id': unique_id,
-                        'bpm': analysis_result['bpm'],
-                        'key': analysis_result['key'],
-                        'camelot_key': analysis_result['camelot_key'],
-                        'energy': analysis_result['energy'],
-                        'duration': analysis_result['duration']
-                    })
-                    uploaded_files_analysis[unique_id] = track_data
-                    newly_processed_tracks.append(track_data)
-                    dj_logger.info(f"Pista de iTunes analizada y añadida: {track_data.get('filename')} (ID: {unique_id})")
+            # El hash del contenido permite reutilizar el parseo si se vuelve a subir la misma biblioteca
+            try:
+                xml_hash = _file_hash(filepath)
+            except OSError as e:
+                dj_logger.warning(f"No se pudo calcular el hash de '{filepath}': {e}")
+                xml_hash = None
+
+            # Las pistas se procesan según se leen del XML: las ya analizadas (mismo contenido) se
+            # toman de la caché y el resto se envía, en lotes, al pool de procesos compartido,
+            # de modo que el análisis empieza antes de que termine el parseo
+            # Pasa el UPLOAD_FOLDER como temp_dir para analyze_audio
+            tracks_to_analyze = [] # pistas cuyo archivo existe en disco, en el orden del XML
+            file_hashes = []
+            cached_results = {}
+            batch_futures = {} # Future -> índices en tracks_to_analyze de su lote
+            batch = []
+            n_tracks = 0
+
+            def submit_batch():
+                if batch:
+                    batch_paths = [tracks_to_analyze[index]['filepath'] for index in batch]
+                    batch_futures[audio_analysis.submit_analysis_batch(batch_paths, UPLOAD_FOLDER)] = list(batch)
+                    batch.clear()
+
+            for track_data in apple_music_integration.stream_itunes_xml(filepath, content_hash=xml_hash):
+                n_tracks += 1
+                # Quedarse solo con las pistas cuyo archivo existe en disco
+                track_path = track_data.get('filepath') or track_data.get('Location')
+                if not (track_path and os.path.exists(track_path)):
+                    dj_logger.warning(f"Ruta de archivo no encontrada o inválida para la pista: {track_data.get('Name')} en {track_path}")
+                    continue
+                track_data['filepath'] = track_path
+                track_data.setdefault('filename', os.path.basename(track_path))
+
+                index = len(tracks_to_analyze)
+                tracks_to_analyze.append(track_data)
+                file_hashes.append(_try_file_hash(track_path))
+                cached = _cache_get(file_hashes[index])
+                if cached is not None:
+                    cached_results[index] = cached
                 else:
-                    dj_logger.warning(f"Ruta de archivo no encontrada o inválida para la pista: {track_data.get('filename')} en {track_path}")
+                    batch.append(index)
+                    if len(batch) >= XML_ANALYSIS_BATCH_SIZE:
+                        submit_batch()
+            submit_batch()
+
+            if not n_tracks:
+                raise ValueError("No se encontraron pistas en el archivo XML o el formato es incorrecto.")
+            dj_logger.info(f"Analizando {len(tracks_to_analyze) - len(cached_results)} pistas de iTunes ({len(cached_results)} en caché).")
+
+            def completed_analyses():
+                yield from cached_results.items()
+                for future in as_completed(batch_futures):
+                    for index, analysis_result in zip(batch_futures[future], future.result()):
+                        if analysis_result['error_message']:
+                            dj_logger.warning(f"Análisis fallido para {tracks_to_analyze[index].get('filename')}: {analysis_result['error_message']}")
+                            continue # Saltar esta pista si falla el análisis
+                        _cache_put(file_hashes[index], analysis_result)
+                        yield index, analysis_result
+
+            processed_by_index = {}
+            for index, analysis_result in completed_analyses():
+                track_data = tracks_to_analyze[index]
+
+                # Generar un ID único para la pista
+                unique_id = _new_track_id()
+
+                # Actualizar los datos de la pista con los resultados del análisis
+                track_data.update({
+                    'id': unique_id,
+                    'bpm': analysis_result['bpm'],
+                    'key': analysis_result['key'],
+                    'camelot_key': analysis_result['camelot_key'],
+                    'energy': analysis_result['energy'],
+                    'duration': analysis_result['duration']
+                })
+                _store_track(unique_id, track_data)
+                processed_by_index[index] = track_data
+                dj_logger.info(f"Pista de iTunes analizada y añadida: {track_data.get('filename')} (ID: {unique_id})")
+
+            # La respuesta conserva el orden del XML
+            newly_processed_tracks = [processed_by_index[index] for index in sorted(processed_by_index)]
 
             # Limpiar el archivo XML después de procesarlo
             if os.path.exists(filepath):
@@ -247,10 +736,30 @@ def upload_xml():
 @dj_bp.route('/api/files', methods=['GET'])
 def get_files():
     # Devuelve la lista de archivos cargados y analizados
-    # Convertimos el diccionario a una lista de sus valores para facilitar el manejo en el frontend
-    files_list = list(uploaded_files_analysis.values())
-    dj_logger.debug(f"Sirviendo {len(files_list)} archivos analizados.")
-    return jsonify(files_list), 200
+    # Convertimos el diccionario a una lista de sus valores para facilitar el manejo en el frontend.
+    # El JSON se serializa solo cuando cambia la lista; los clientes que reenvían el ETag
+    # (If-None-Match) reciben 304 sin cuerpo.
+    global _files_response_cache
+    with _state_lock:
+        version = _files_version
+        cached = _files_response_cache
+        if cached is None or cached[0] != version:
+            files_list = list(uploaded_files_analysis.values())
+            cached = None
+
+    if cached is None:
+        body = flask_json.dumps(files_list)
+        etag = hashlib.blake2b(body.encode('utf-8'), digest_size=8).hexdigest()
+        cached = (version, etag, body)
+        with _state_lock:
+            if _files_version == version:
+                _files_response_cache = cached
+        dj_logger.debug(f"Sirviendo {len(files_list)} archivos analizados.")
+
+    _, etag, body = cached
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @dj_bp.route('/api/generate-playlist', methods=['POST'])
 def generate_playlist_route():
@@ -262,7 +771,7 @@ def generate_playlist_route():
 
     selected_tracks_for_playlist = []
     for track_id in track_ids:
-        track_info = uploaded_files_analysis.get(track_id)
+        track_info = _get_track(track_id)
         if track_info:
             selected_tracks_for_playlist.append(track_info)
         else:
@@ -280,9 +789,79 @@ def generate_playlist_route():
         dj_logger.error(f"Error al generar la lista de reproducción: {e}", exc_info=True)
         return jsonify({'error': f'Error al generar la lista de reproducción: {e}'}), 500
 
+# Rutas pedidas de un mismo directorio a partir de las cuales compensa listarlo con scandir
+# en lugar de hacer un stat por archivo
+SCANDIR_MIN_FILES = 8
+
+def _existing_files(filepaths) -> set:
+    """
+    Retorna el conjunto de rutas (normalizadas) de filepaths que existen y son archivos.
+    Los directorios con muchas de las rutas se listan una sola vez con os.scandir, pero solo como
+    comprobación positiva rápida: lo que no aparece en el listado se comprueba con os.path.isfile,
+    porque el nombre del listado puede no coincidir byte a byte con la ruta pedida aunque sea el
+    mismo archivo (mayúsculas/minúsculas o Unicode NFC/NFD en macOS).
+    """
+    by_directory = {}
+    for path in filepaths:
+        if path:
+            path = os.path.normpath(path)
+            by_directory.setdefault(os.path.dirname(path), []).append(path)
+
+    existing = set()
+    for directory, paths in by_directory.items():
+        listed = set()
+        if len(paths) >= SCANDIR_MIN_FILES:
+            try:
+                with os.scandir(directory or '.') as entries:
+                    listed = {os.path.join(directory, entry.name) for entry in entries if entry.is_file()}
+            except OSError:
+                pass # Se comprueban una a una
+        existing.update(path for path in paths if path in listed or os.path.isfile(path))
+    return existing
+
+# Las mezclas se generan de una en una en un hilo aparte (mix_status describe una sola mezcla).
+# El trabajo pesado (pydub/ffmpeg, numpy, scipy) libera el GIL la mayor parte del tiempo.
+_mix_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dj-mix')
+
+# Duración de la mezcla si la petición no indica 'mix_duration_minutes', y máxima admitida
+# (la mezcla se construye en memoria: ~600 MB por hora a 44,1 kHz estéreo)
+DEFAULT_MIX_DURATION_MINUTES = 60
+MAX_MIX_DURATION_MINUTES = int(os.environ.get('DJ_MAX_MIX_MINUTES', 240))
+
+def _mix_progress(progress, message, is_error=False):
+    """Callback de progreso de mixing_engine.create_mix: lo refleja en mix_status."""
+    changes = {'progress': progress, 'message': message}
+    if is_error:
+        changes['error_details'] = message
+    _store_mix_status(**changes)
+
+def _run_mix(playlist_tracks, mix_duration_minutes):
+    """Genera la mezcla (en el hilo de _mix_executor) y deja el resultado en mix_status."""
+    try:
+        # Pasa MIX_OUTPUT_FOLDER al mixing_engine
+        _, output_mix_filename = mixing_engine.create_mix(playlist_tracks, MIX_OUTPUT_FOLDER,
+                                                          mix_duration_minutes, _mix_progress)
+        if not output_mix_filename:
+            raise RuntimeError(_get_mix_status()['error_details'] or 'No se pudo generar la mezcla.')
+
+        _store_mix_status(status='completed', progress=100, message='Mezcla generada con éxito.',
+                          output_file=output_mix_filename)
+        dj_logger.info(f"Mezcla completada: {output_mix_filename}")
+
+    except FileNotFoundError as fe:
+        # Un archivo validado en generate_mix ha desaparecido antes de mezclarse
+        # (mixing_engine.create_mix lo propaga si falta la primera pista)
+        _store_mix_status(status='error', message=f'Archivo de pista no encontrado: {fe.filename}')
+        dj_logger.error(f"Archivo de pista no encontrado al generar la mezcla: {fe}")
+    except ValueError as ve:
+        _store_mix_status(status='error', message=f'Error de validación: {str(ve)}')
+        dj_logger.error(f"Error de validación al generar la mezcla: {ve}")
+    except Exception as e:
+        _store_mix_status(status='error', message=f'Error inesperado durante la mezcla: {str(e)}')
+        dj_logger.error(f"Error inesperado al generar la mezcla: {e}", exc_info=True)
+
 @dj_bp.route('/api/generate-mix', methods=['POST'])
 def generate_mix():
-    global mix_status
     data = request.get_json()
     playlist_tracks = data.get('playlist', [])
 
@@ -290,72 +869,66 @@ def generate_mix():
         return jsonify({'error': 'No se proporcionaron pistas para generar la mezcla.'}), 400
 
     # Validar que todas las pistas en la playlist tienen 'filepath'
+    existing_files = _existing_files(track.get('filepath') for track in playlist_tracks)
     for track in playlist_tracks:
-        if 'filepath' not in track or not os.path.exists(track['filepath']):
+        if not track.get('filepath') or os.path.normpath(track['filepath']) not in existing_files:
             return jsonify({'error': f"La pista '{track.get('filename', 'Unknown')}' no tiene una ruta de archivo válida o el archivo no existe."}), 400
 
-    # Iniciar la generación de la mezcla en un hilo o proceso separado
-    # Esto es crucial para no bloquear la solicitud HTTP
-    mix_status = {
-        'status': 'processing',
-        'progress': 0,
-        'message': 'Iniciando la generación de la mezcla...',
-        'output_file': None,
-        'error_details': None
-    }
-    
-    # Para simplificar, aquí no se usa un hilo separado. En una aplicación real,
-    # se usaría `threading.Thread` o `multiprocessing.Process` para esto.
-    # Por ahora, la mezcla se ejecutará de forma síncrona.
-    dj_logger.info("Iniciando proceso de mezcla (síncrono por simplicidad).")
     try:
-        # Pasa MIX_OUTPUT_FOLDER al mixing_engine
-        output_mix_filename = mixing_engine.create_full_mix(playlist_tracks, MIX_OUTPUT_FOLDER, mix_status)
-        
-        mix_status['status'] = 'completed'
-        mix_status['progress'] = 100
-        mix_status['message'] = 'Mezcla generada con éxito.'
-        mix_status['output_file'] = output_mix_filename
-        dj_logger.info(f"Mezcla completada: {output_mix_filename}")
-        return jsonify(mix_status), 200
-
-    except ValueError as ve:
-        mix_status['status'] = 'error'
-        mix_status['message'] = f'Error de validación: {str(ve)}'
-        dj_logger.error(f"Error de validación al generar la mezcla: {ve}")
-        return jsonify(mix_status), 400
-    except Exception as e:
-        mix_status['status'] = 'error'
-        mix_status['message'] = f'Error inesperado durante la mezcla: {str(e)}'
-        dj_logger.error(f"Error inesperado al generar la mezcla: {e}", exc_info=True)
-        return jsonify(mix_status), 500
+        mix_duration_minutes = int(data.get('mix_duration_minutes', DEFAULT_MIX_DURATION_MINUTES))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'mix_duration_minutes debe ser un número entero de minutos.'}), 400
+    if not 0 < mix_duration_minutes <= MAX_MIX_DURATION_MINUTES:
+        return jsonify({'error': f'mix_duration_minutes debe estar entre 1 y {MAX_MIX_DURATION_MINUTES}.'}), 400
+
+    # Iniciar la generación de la mezcla en un hilo separado
+    # Esto es crucial para no bloquear la solicitud HTTP: el cliente consulta /api/mix-status
+    with _state_lock:
+        if mix_status['status'] == 'processing':
+            return jsonify({'error': 'Ya hay una mezcla en curso.', **mix_status}), 409
+        status = _store_mix_status(reset=True, status='processing', message='Iniciando la generación de la mezcla...')
+
+    dj_logger.info("Iniciando proceso de mezcla en segundo plano.")
+    _mix_executor.submit(_run_mix, playlist_tracks, mix_duration_minutes)
+    return jsonify(status), 202
 
 @dj_bp.route('/api/mix-status', methods=['GET'])
 def get_mix_status():
     """Devuelve el estado actual de la generación de la mezcla."""
-    dj_logger.debug(f"Verificando estado de la mezcla: {mix_status['status']}")
-    return jsonify(mix_status), 200
+    status = _get_mix_status()
+    dj_logger.debug(f"Verificando estado de la mezcla: {status['status']}")
+    return jsonify(status), 200
 
 @dj_bp.route('/api/download-mix/<filename>', methods=['GET'])
 def download_mix(filename):
     """Permite la descarga del archivo de mezcla generado."""
     output_mix_dir = MIX_OUTPUT_FOLDER
-    full_path = os.path.join(output_mix_dir, filename)
+    # safe_join evita que 'filename' apunte fuera del directorio de mezclas (retorna None)
+    full_path = safe_join(output_mix_dir, filename)
+
+    if full_path:
+        # Se intenta enviar directamente (send_file hace un único stat) en lugar de comprobar
+        # antes si el archivo existe: menos llamadas al sistema y sin carrera entre comprobar y abrir.
+        # Usar as_attachment=True para forzar la descarga en el navegador.
+        # conditional=True responde 304 y peticiones Range (descargas reanudables); el archivo
+        # lo envía el servidor WSGI (wsgi.file_wrapper/sendfile) o, con USE_X_SENDFILE=1,
+        # el proxy delante de la aplicación (cabecera X-Sendfile).
+        try:
+            response = send_file(full_path, as_attachment=True, download_name=filename, mimetype='audio/mpeg',
+                                 conditional=True, etag=True)
+            dj_logger.info(f"Sirviendo archivo de mezcla: {full_path}")
+            return response
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError):
+            pass
 
-    if os.path.exists(full_path) and os.path.isfile(full_path):
-        dj_logger.info(f"Sirviendo archivo de mezcla: {full_path}")
-        # Usar as_attachment=True para forzar la descarga en el navegador
-        return send_file(full_path, as_attachment=True, download_name=filename, mimetype='audio/mp3')
-    else:
-        dj_logger.warning(f"Intento de descarga de archivo no encontrado: {full_path}")
-        return jsonify({'error': 'Archivo de mezcla no encontrado.'}), 404
+    dj_logger.warning(f"Intento de descarga de archivo no encontrado: {full_path}")
+    return jsonify({'error': 'Archivo de mezcla no encontrado.'}), 404
 
 @dj_bp.route('/api/clear-files', methods=['POST'])
 def clear_files_route():
     """
     API endpoint to clear all temporary files.
     """
-    global uploaded_files_analysis
     dj_logger.info("Recibida solicitud para limpiar todos los archivos temporales.")
     result = clear_temp_files()
     if result[0]: # result[0] es el booleano de éxito
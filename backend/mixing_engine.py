@@ -2,14 +2,52 @@ import os
 import sys
 from pydub import AudioSegment
 import tempfile
+import shutil
 import time
 import logging
+import threading
+# Caché en disco de las funciones compiladas con numba (las de este módulo y las de librosa),
+# para pagar la compilación JIT una sola vez. Debe fijarse antes de importar librosa/numba.
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dj_numba_cache'))
 import numpy as np
 import librosa
 import soundfile as sf # Para leer/escribir archivos de audio con librosa
-import random # Para decisiones "creativas" en las transiciones
 import math # Para funciones de fundido
-from scipy.signal import butter, lfilter # Para filtros básicos (simulación de EQ)
+import hashlib
+import errno
+from fractions import Fraction
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from scipy.signal import resample_poly # Para el cambio de frecuencia de muestreo
+
+# pyrubberband (Rubber Band, en C++) estira el tempo más rápido y con menos artefactos que el
+# phase vocoder de librosa, y trabaja en estéreo. Es opcional (necesita el ejecutable rubberband):
+# sin él se usa librosa.effects.time_stretch.
+try:
+    import pyrubberband as pyrb
+except ImportError:
+    pyrb = None
+
+# lameenc codifica el MP3 final dentro del proceso, sin escribir un WAV temporal ni lanzar FFmpeg.
+# Es opcional: sin él se exporta con pydub/FFmpeg.
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+# PyAV decodifica con libavcodec dentro del proceso (sin lanzar ffmpeg/ffprobe por pista) y
+# libera el GIL, así que la precarga en segundo plano de create_mix decodifica en paralelo.
+# Es opcional: sin él, lo que no lee soundfile se decodifica con librosa.load (audioread).
+try:
+    import av
+except ImportError:
+    av = None
+
+# numba (dependencia de librosa) compila el bucle del crossfade; sin él se usa NumPy
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 # --- INICIO DE LA MODIFICACIÓN (Añadir estas líneas) ---
 # Establecer la ruta a los ejecutables de FFmpeg para pydub
@@ -21,11 +59,15 @@ AudioSegment.ffprobe = "/usr/local/bin/ffprobe"
 
 # Configuración del logger para mixing_engine
 mixing_logger = logging.getLogger('mixing_engine_module')
-mixing_logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stderr)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-mixing_logger.addHandler(handler)
+mixing_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# El handler se añade una sola vez aunque el módulo se reimporte (recargas, tests)
+if not mixing_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    mixing_logger.addHandler(handler)
+# No propagar al logger raíz para no escribir cada línea dos veces
+mixing_logger.propagate = False
 
 # Constantes para la mezcla
 SHORT_TRANSITION_MS = 4 * 1000  # 4 segundos para cortes o fades rápidos
@@ -45,65 +87,321 @@ MIN_TRACK_MIX_END_MS = 15 * 1000   # No mezclar los últimos 15 segundos del tra
 UPLOAD_FOLDER = os.path.join(tempfile.gettempdir(), 'dj_uploads')
 
 
-def adjust_tempo_librosa(audio_segment: AudioSegment, target_bpm: float, current_bpm: float) -> AudioSegment:
+@dataclass
+class AudioBuffer:
     """
-    Ajusta el tempo de una pista usando librosa.effects.time_stretch para preservar el tono.
-    Convierte el segmento de pydub a numpy array, aplica time-stretching con librosa,
-    y convierte el resultado de vuelta a un AudioSegment de pydub.
+    Audio decodificado en memoria con el que trabaja todo el motor de mezcla.
+    samples: muestras int16 con forma (n_muestras, canales).
+    sr: frecuencia de muestreo.
+    duration_ms: duración en milisegundos (entero), calculada una sola vez al crear el buffer.
+    Solo la exportación final pasa por pydub/FFmpeg.
+    """
+    samples: np.ndarray
+    sr: int
+    duration_ms: int = field(init=False)
+
+    def __post_init__(self):
+        self.duration_ms = self.samples.shape[0] * 1000 // self.sr
+
+    @property
+    def channels(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.samples.shape[0] / self.sr
+
+    def slice_ms(self, start_ms: float = 0, end_ms: float = None) -> 'AudioBuffer':
+        """Tramo [start_ms, end_ms) como vista de las mismas muestras (sin copiarlas)."""
+        start = int(start_ms * self.sr / 1000)
+        end = None if end_ms is None else int(end_ms * self.sr / 1000)
+        return AudioBuffer(self.samples[start:end], self.sr)
+
+class _MixBuffer:
+    """
+    Buffer de salida de la mezcla reservado una sola vez con la duración objetivo.
+    Las pistas y transiciones se escriben por asignación de tramos con un cursor, en lugar de
+    concatenar arrays (que copiaría toda la mezcla en cada transición). Lo que exceda la
+    duración objetivo se descarta al escribir.
+    """
+
+    def __init__(self, duration_ms: int, sr: int, channels: int):
+        self.sr = sr
+        self.channels = channels
+        self._samples = np.empty((duration_ms * sr // 1000, channels), dtype=np.int16)
+        self._pos = 0
+        self.truncated = False
+
+    @property
+    def duration_ms(self) -> int:
+        return self._pos * 1000 // self.sr
+
+    def rewind(self, frames: int):
+        """Retrocede el cursor para sobrescribir las últimas 'frames' muestras."""
+        self._pos = max(0, self._pos - frames)
+
+    def append(self, samples: np.ndarray):
+        n = min(samples.shape[0], self._samples.shape[0] - self._pos)
+        if n < samples.shape[0]:
+            self.truncated = True
+        self._samples[self._pos:self._pos + n] = samples[:n]
+        self._pos += n
+
+    def to_audio(self) -> AudioBuffer:
+        return AudioBuffer(self._samples[:self._pos], self.sr)
+
+# Escala entre muestras int16 y audio en coma flotante en [-1, 1)
+_INT16_SCALE = 32768.0
+
+def _to_float32(samples: np.ndarray) -> np.ndarray:
+    """Muestras int16 -> float32 normalizado a [-1, 1), el rango que esperan librosa y Rubber Band."""
+    return samples.astype(np.float32) * np.float32(1.0 / _INT16_SCALE)
+
+def _to_int16(y: np.ndarray) -> np.ndarray:
+    """Audio float en [-1, 1) -> muestras int16, recortando lo que se salga del rango."""
+    return np.clip(y * np.float32(_INT16_SCALE), -32768, 32767).astype(np.int16, order='C')
+
+def _decode_av(filepath: str) -> tuple[np.ndarray, int]:
+    """Decodifica la primera pista de audio de un archivo con PyAV a muestras int16 (n_muestras, canales)."""
+    with av.open(filepath) as container:
+        stream = container.streams.audio[0]
+        channels = stream.channels
+        # Convertir cualquier formato de muestra (fltp, s32p, ...) a int16 entrelazado
+        resampler = av.AudioResampler(format='s16', layout=stream.layout.name, rate=stream.rate)
+        chunks = []
+        for frame in container.decode(stream):
+            chunks.extend(f.to_ndarray() for f in resampler.resample(frame))
+        chunks.extend(f.to_ndarray() for f in resampler.resample(None))
+    if not chunks:
+        return np.zeros((0, channels), dtype=np.int16), stream.rate
+    # s16 entrelazado: cada bloque tiene forma (1, n_muestras * canales)
+    return np.concatenate(chunks, axis=1).reshape(-1, channels), stream.rate
+
+def _load_audio(filepath: str) -> AudioBuffer:
+    """
+    Decodifica un archivo de audio directamente a un AudioBuffer int16, sin pasar por AudioSegment:
+    con soundfile (WAV, FLAC, OGG, AIFF y MP3 con libsndfile >= 1.1) y, si no puede leerlo,
+    con PyAV o, sin él, con librosa.load (audioread/FFmpeg).
+    Lanza FileNotFoundError si el archivo no existe.
+    """
+    try:
+        samples, sr = sf.read(filepath, dtype='int16', always_2d=True)
+    except RuntimeError as e: # sf.LibsndfileError: formato no soportado por libsndfile
+        # libsndfile informa igual de un archivo inexistente: solo entonces se comprueba
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filepath) from e
+        if av is not None:
+            mixing_logger.debug(f"soundfile no pudo leer '{filepath}' ({e}). Usando PyAV.")
+            samples, sr = _decode_av(filepath)
+            return AudioBuffer(samples, sr)
+        mixing_logger.debug(f"soundfile no pudo leer '{filepath}' ({e}). Usando librosa.load.")
+        y, sr = librosa.load(filepath, sr=None, mono=False, dtype=np.float32)
+        # librosa devuelve (canales, n_muestras) o (n_muestras,) si es mono
+        y = np.atleast_2d(y).T
+        samples = _to_int16(y)
+    return AudioBuffer(np.ascontiguousarray(samples), sr)
+
+def _match_format(audio: AudioBuffer, sr: int, channels: int) -> AudioBuffer:
+    """Convierte audio (solo si hace falta) a la frecuencia de muestreo y número de canales indicados."""
+    samples = audio.samples
+    if audio.sr != sr:
+        g = math.gcd(sr, audio.sr)
+        samples = resample_poly(samples, sr // g, audio.sr // g, axis=0)
+        samples = np.clip(samples, -32768, 32767).astype(np.int16)
+    if samples.shape[1] != channels:
+        # Mezcla a mono y, si hace falta, se replica en todos los canales
+        mono = samples.mean(axis=1, keepdims=True, dtype=np.float32)
+        samples = np.repeat(mono, channels, axis=1).astype(np.int16)
+    return AudioBuffer(samples, sr)
+
+# Ajuste de tempo: por debajo de TEMPO_SKIP_TOLERANCE de diferencia no se estira (inaudible);
+# hasta TEMPO_RESAMPLE_TOLERANCE se cambia la velocidad con un remuestreo polifásico (sin STFT),
+# que también desplaza el tono, pero como mucho ~0,34 semitonos
+TEMPO_SKIP_TOLERANCE = 0.01
+TEMPO_RESAMPLE_TOLERANCE = 0.02
+
+# Caché en disco (FLAC, sin pérdidas) de las pistas ya estiradas, para no repetir el
+# time-stretch al volver a mezclar las mismas pistas contra el mismo BPM. Es un LRU acotado a
+# TEMPO_CACHE_MAX_MB (por fecha de modificación, que se actualiza en cada acierto) y se vacía
+# con dj.clear_temp_files
+TEMPO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'dj_tempo_cache')
+TEMPO_CACHE_MAX_MB = int(os.environ.get('DJ_TEMPO_CACHE_MAX_MB', 2048))
+
+def _tempo_cache_path(src_path: str, audio: AudioBuffer, current_bpm: float, target_bpm: float) -> str:
+    """Ruta en la caché para src_path (identificado por ruta y mtime) estirado de current_bpm a target_bpm."""
+    key = f"{src_path}:{os.path.getmtime(src_path)}:{audio.sr}:{audio.channels}:{current_bpm:.2f}:{target_bpm:.2f}"
+    return os.path.join(TEMPO_CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.flac')
+
+def _trim_tempo_cache():
+    """Borra las entradas menos usadas de TEMPO_CACHE_DIR hasta que ocupe como mucho TEMPO_CACHE_MAX_MB."""
+    entries = []
+    try:
+        with os.scandir(TEMPO_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.flac') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError as e:
+        mixing_logger.debug(f"No se pudo recorrer la caché de tempo: {e}")
+        return
+
+    total = sum(size for _, size, _ in entries)
+    limit = TEMPO_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def _time_stretch(audio: AudioBuffer, ratio: float) -> AudioBuffer:
+    """Estira el tempo por 'ratio' preservando el tono, con Rubber Band o, sin él, con librosa."""
+    sr = audio.sr
+    # Todo el estiramiento se hace en float32 normalizado a [-1, 1); solo se vuelve a int16
+    # una vez, al construir el AudioBuffer resultante
+    y = _to_float32(audio.samples)
+
+    if pyrb is not None:
+        try:
+            # Rubber Band procesa todos los canales a la vez, conservando la imagen estéreo
+            y_stretched = pyrb.time_stretch(y, sr, ratio)
+            return AudioBuffer(_to_int16(y_stretched.reshape(-1, audio.channels)), sr)
+        except Exception as e:
+            mixing_logger.warning(f"Rubber Band no pudo ajustar el tempo ({e}). Usando librosa.")
+
+    # librosa estira cada canal por separado (admite arrays (canales, n_muestras)), así que el
+    # estéreo se conserva en lugar de promediar a mono y duplicar. Todos los canales salen con
+    # la misma longitud.
+    y_stretched = librosa.effects.time_stretch(np.ascontiguousarray(y.T), rate=ratio).T
+
+    # librosa devuelve float32 en el mismo rango de la entrada: se reescala a int16 una sola vez
+    # (antes se multiplicaba por 32767 audio que ya estaba en escala int16 y se desbordaba)
+    return AudioBuffer(_to_int16(y_stretched), sr)
+
+def adjust_tempo_librosa(audio: AudioBuffer, target_bpm: float, current_bpm: float, src_path: str = None) -> AudioBuffer:
+    """
+    Ajusta el tempo de una pista preservando el tono, con Rubber Band si está disponible
+    o con librosa.effects.time_stretch en caso contrario.
+    Recibe y retorna un AudioBuffer (muestras int16).
+    src_path: archivo del que procede el audio; si se indica, el resultado se guarda en
+    (y se reutiliza de) la caché en disco TEMPO_CACHE_DIR.
     """
     if current_bpm is None or target_bpm is None or current_bpm == 0:
         mixing_logger.warning("BPM actual o objetivo no válido para ajuste de tempo. Retornando segmento original.")
-        return audio_segment
+        return audio
 
     ratio = target_bpm / current_bpm
-    if ratio == 1:
-        return audio_segment # No es necesario ajustar si los BPM son los mismos
+    if abs(ratio - 1.0) < TEMPO_SKIP_TOLERANCE:
+        mixing_logger.debug(f"Ratio de tempo {ratio:.3f} próximo a 1. No se ajusta el tempo.")
+        return audio # No es necesario ajustar si los BPM son (casi) los mismos
 
     mixing_logger.debug(f"Ajustando tempo de {current_bpm:.2f} BPM a {target_bpm:.2f} BPM (ratio: {ratio:.2f}).")
 
-    # Convertir AudioSegment a numpy array
-    # pydub.AudioSegment.get_array_of_samples() devuelve un array de enteros
-    y = np.array(audio_segment.get_array_of_samples()).astype(np.float32)
-    sr = audio_segment.frame_rate
-
-    # Si el audio es estéreo, librosa espera un array de una dimensión para el análisis
-    # y el time-stretching. Promediamos los canales si es estéreo para el análisis
-    # y luego lo aplicamos al AudioSegment completo.
-    if audio_segment.channels == 2:
-        # Pydub devuelve los canales entrelazados (LRLR...), los separamos
-        y_left = y[0::2]
-        y_right = y[1::2]
-        y_mono = (y_left + y_right) / 2.0 # Convertir a mono para librosa
-
-        # Aplicar time-stretch al audio mono
-        y_stretched_mono = librosa.effects.time_stretch(y_mono, rate=ratio)
-
-        # Para reconstruir un audio estéreo, podemos duplicar el canal mono estirado
-        # o aplicar el estiramiento a cada canal por separado y luego entrelazar.
-        # Duplicar el canal mono estirado es más sencillo y suele ser suficiente.
-        y_stretched = np.empty((y_stretched_mono.size * 2,), dtype=y_stretched_mono.dtype)
-        y_stretched[0::2] = y_stretched_mono
-        y_stretched[1::2] = y_stretched_mono
-        output_channels = 2
+    if abs(ratio - 1.0) < TEMPO_RESAMPLE_TOLERANCE:
+        # Acelerar por 'ratio' = quedarse con n/ratio muestras: filtro polifásico up/down
+        speed = Fraction(ratio).limit_denominator(1000)
+        y_resampled = resample_poly(_to_float32(audio.samples), speed.denominator, speed.numerator, axis=0)
+        return AudioBuffer(_to_int16(y_resampled), audio.sr)
+
+    cache_path = None
+    if src_path:
+        try:
+            cache_path = _tempo_cache_path(src_path, audio, current_bpm, target_bpm)
+            if os.path.exists(cache_path):
+                samples, sr = sf.read(cache_path, dtype='int16', always_2d=True)
+                os.utime(cache_path) # Marca la entrada como usada recientemente (LRU)
+                mixing_logger.debug(f"Tempo de '{src_path}' leído de la caché: {cache_path}")
+                return AudioBuffer(samples, sr)
+        except sf.LibsndfileError as e:
+            # Entrada corrupta o truncada: se descarta y se vuelve a generar
+            mixing_logger.debug(f"Entrada de la caché de tempo ilegible '{cache_path}': {e}")
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+        except OSError as e:
+            mixing_logger.debug(f"No se pudo usar la caché de tempo para '{src_path}': {e}")
+
+    stretched = _time_stretch(audio, ratio)
+
+    if cache_path:
+        # Escritura atómica: un archivo a medio escribir nunca se lee como entrada válida
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(TEMPO_CACHE_DIR, exist_ok=True)
+            sf.write(tmp_path, stretched.samples, stretched.sr, format='FLAC')
+            os.replace(tmp_path, cache_path)
+            _trim_tempo_cache()
+        except Exception as e:
+            mixing_logger.warning(f"No se pudo guardar en la caché de tempo '{cache_path}': {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return stretched
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _xfade_kernel(out_samples, in_samples, gain_out, gain_in, dst):
+        """Multiplica, suma, recorta y convierte a int16 en una sola pasada, sin buffers temporales."""
+        n, channels = dst.shape
+        for i in prange(n):
+            for c in range(channels):
+                v = out_samples[i, c] * gain_out[i] + in_samples[i, c] * gain_in[i]
+                if v > 32767.0:
+                    v = 32767.0
+                elif v < -32768.0:
+                    v = -32768.0
+                dst[i, c] = np.int16(v)
+else:
+    _xfade_kernel = None
+
+def _crossfade_np(out_audio: AudioBuffer, in_audio: AudioBuffer, dur_ms: int, curve: str = 'equal_power') -> np.ndarray:
+    """
+    Crossfade entre el final de out_audio y el principio de in_audio en una sola pasada
+    (sustituye a fade_out + fade_in + overlay de pydub, que recorren las muestras en Python).
+    Ambos deben tener el mismo formato (ver _match_format).
+    curve: 'equal_power' (seno/coseno, volumen percibido constante) o 'linear'.
+    Retorna las muestras int16 (n_muestras, canales) del tramo mezclado.
+    """
+    out_samples, in_samples = out_audio.samples, in_audio.samples
+    n = min(int(dur_ms * out_audio.sr / 1000), out_samples.shape[0], in_samples.shape[0])
+
+    # Rampas de ganancia de la pista saliente (1 -> 0) y de la entrante (0 -> 1)
+    ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+    if curve == 'equal_power':
+        gain_in = np.sin(ramp * np.float32(np.pi / 2))
+        gain_out = np.cos(ramp * np.float32(np.pi / 2))
     else:
-        # Si es mono, aplicar directamente
-        y_stretched = librosa.effects.time_stretch(y, rate=ratio)
-        output_channels = 1
-    
-    # Convertir el array de numpy a un AudioSegment
-    # Asegúrate de que el tipo de datos sea compatible con pydub (int16 para AudioSegment por defecto)
-    # y escalar si es necesario.
-    # librosa devuelve floats, pydub espera ints. Multiplicar por 2^15 para int16.
-    max_val = np.iinfo(np.int16).max
-    y_stretched = (y_stretched * max_val).astype(np.int16)
-
-    stretched_audio_segment = AudioSegment(
-        y_stretched.tobytes(), 
-        frame_rate=sr,
-        sample_width=audio_segment.sample_width,
-        channels=output_channels
-    )
-    return stretched_audio_segment
+        gain_in = ramp
+        gain_out = 1.0 - ramp
+
+    out_tail = out_samples[out_samples.shape[0] - n:]
+    in_head = in_samples[:n]
+    if _xfade_kernel is not None:
+        mixed = np.empty_like(out_tail)
+        _xfade_kernel(out_tail, in_head, gain_out, gain_in, mixed)
+    else:
+        mixed = out_tail * gain_out[:, None] + in_head * gain_in[:, None]
+        mixed = np.clip(mixed, -32768, 32767).astype(np.int16)
+    return mixed
+
+def _load_and_stretch(track_info: dict, target_bpm: float, sr: int, channels: int) -> tuple[AudioBuffer, AudioBuffer]:
+    """
+    Carga una pista en el formato de la mezcla y le ajusta el tempo a target_bpm.
+    create_mix la ejecuta en segundo plano para la pista siguiente mientras mezcla la actual.
+    Retorna (audio_original, audio_ajustado); si falla el ajuste de tempo se usa el original.
+    """
+    audio = _match_format(_load_audio(track_info['filepath']), sr, channels)
+    try:
+        adjusted = adjust_tempo_librosa(audio, target_bpm=target_bpm, current_bpm=track_info['bpm'],
+                                        src_path=track_info['filepath'])
+    except Exception as e:
+        mixing_logger.error(f"Error al ajustar el tempo de '{track_info.get('filename', 'N/A')}': {e}. Se usa sin ajustar.", exc_info=True)
+        adjusted = audio
+    return audio, adjusted
 
 def get_bpm_adjusted_transition_duration(bpm: float) -> int:
     """
@@ -125,72 +423,85 @@ def get_bpm_adjusted_transition_duration(bpm: float) -> int:
     # Asegurarse de que la duración esté dentro de límites razonables
     return max(SHORT_TRANSITION_MS, min(calculated_duration_ms, LONG_TRANSITION_MS * 2)) # Un poco más flexible
 
-def apply_eq(audio_segment: AudioSegment, eq_type: str, freq: float, q: float = 1.0, gain_db: float = 0.0) -> AudioSegment:
+# Pico máximo de la mezcla final (-0.1 dBFS) y umbral a partir del cual se normaliza
+NORMALIZE_PEAK = 32440
+NORMALIZE_THRESHOLD = int(32767 * 0.99)
+
+def _normalize_peak(samples: np.ndarray, block_frames: int = 1 << 20):
     """
-    Aplica una simulación básica de ecualización (filtro Butterworth) a un AudioSegment.
-    eq_type: 'lowpass', 'highpass', 'bandpass', 'lowshelf', 'highshelf'.
-    freq: Frecuencia de corte para lowpass/highpass, o frecuencia central para bandpass/shelf.
-    q: Factor de calidad para bandpass/shelf.
-    gain_db: Ganancia en dB para shelf.
+    Normalización única de toda la mezcla: si el pico supera NORMALIZE_THRESHOLD se escala
+    (en el mismo array, por bloques y con aritmética entera) para dejarlo en NORMALIZE_PEAK.
     """
-    # Convertir AudioSegment a numpy array
-    y = np.array(audio_segment.get_array_of_samples()).astype(np.float32)
-    sr = audio_segment.frame_rate
-    channels = audio_segment.channels
-
-    if channels == 2:
-        # Si es estéreo, se procesa cada canal por separado o se convierte a mono, procesa y duplica.
-        # Para simplicidad y rendimiento, promediamos a mono, aplicamos EQ y luego duplicamos.
-        y_mono = (y[0::2] + y[1::2]) / 2.0
-    else:
-        y_mono = y
-
-    nyquist = 0.5 * sr
-    normalized_freq = freq / nyquist
-
-    if eq_type == 'lowpass':
-        b, a = butter(4, normalized_freq, btype='low', analog=False)
-    elif eq_type == 'highpass':
-        b, a = butter(4, normalized_freq, btype='high', analog=False)
-    # Otros tipos de EQ (shelf, bandpass) requieren implementaciones más complejas o librerías especializadas
-    # como `scipy.signal.iirfilter` con tipos 'lowshelf'/'highshelf' que son más complejos de usar
-    # directamente sin un conocimiento profundo de diseño de filtros.
-    # Por ahora, nos quedamos con lowpass y highpass, que son los más comunes para crossfades.
-    else:
-        mixing_logger.warning(f"Tipo de EQ '{eq_type}' no soportado para simulación básica. Saltando EQ.")
-        return audio_segment # Retorna el audio original si el tipo no es soportado
-
-    # Aplicar el filtro
-    y_filtered_mono = lfilter(b, a, y_mono)
-
-    # Reconvertir a estéreo si era originalmente estéreo
-    if channels == 2:
-        y_filtered = np.empty((y_filtered_mono.size * 2,), dtype=y_filtered_mono.dtype)
-        y_filtered[0::2] = y_filtered_mono
-        y_filtered[1::2] = y_filtered_mono
-    else:
-        y_filtered = y_filtered_mono
-
-    # Escalar y convertir a int16 para pydub
-    max_val = np.iinfo(np.int16).max
-    y_filtered = (y_filtered / np.max(np.abs(y_filtered)) * max_val).astype(np.int16) # Normalizar antes de convertir
-
-    return AudioSegment(
-        y_filtered.tobytes(),
-        frame_rate=sr,
-        sample_width=audio_segment.sample_width,
-        channels=channels
-    )
-
-
-def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, progress_callback=None) -> tuple[AudioSegment, str]:
+    if samples.size == 0:
+        return
+    # max/min por separado: abs() de -32768 se desborda en int16
+    peak = max(int(samples.max()), -int(samples.min()))
+    if peak <= NORMALIZE_THRESHOLD:
+        return
+    mixing_logger.debug(f"Normalizando la mezcla final (pico {peak} -> {NORMALIZE_PEAK}).")
+    for start in range(0, samples.shape[0], block_frames):
+        block = samples[start:start + block_frames]
+        block[...] = block.astype(np.int32) * NORMALIZE_PEAK // peak
+
+MP3_BITRATE_KBPS = 192 # Calidad razonable
+
+def _export_mp3(audio: AudioBuffer, output_filepath: str):
+    """
+    Codifica un AudioBuffer a MP3. Con lameenc se codifica en bloques de 1 segundo directamente
+    al archivo de salida; si no está disponible, con una única llamada a pydub/FFmpeg.
+    """
+    if lameenc is not None and audio.channels in (1, 2):
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(MP3_BITRATE_KBPS)
+        encoder.set_in_sample_rate(audio.sr)
+        encoder.set_channels(audio.channels)
+        encoder.set_quality(2) # 2 = alta calidad, 7 = rápido
+        with open(output_filepath, 'wb') as f:
+            for start in range(0, audio.samples.shape[0], audio.sr):
+                f.write(encoder.encode(np.ascontiguousarray(audio.samples[start:start + audio.sr]).tobytes()))
+            f.write(encoder.flush())
+        return
+
+    AudioSegment(
+        np.ascontiguousarray(audio.samples).tobytes(),
+        frame_rate=audio.sr,
+        sample_width=2,
+        channels=audio.channels
+    ).export(output_filepath, format="mp3", bitrate=f"{MP3_BITRATE_KBPS}k")
+
+# Margen (ms) por pista al estimar la duración máxima de la mezcla: redondeos del remuestreo y
+# los 5 s que se repiten cuando falla una transición (ver create_mix)
+MIX_BUFFER_MARGIN_MS = 10_000
+
+def _max_mix_duration_ms(playlist: list, target_ms: int) -> int:
+    """
+    Duración máxima que puede alcanzar la mezcla de 'playlist': la suma de sus pistas, cada una
+    alargada por su ajuste de tempo (la pista i se estira al BPM de la i-1), más un margen por
+    pista, sin pasar de target_ms. Así el buffer de _MixBuffer no se dimensiona con una duración
+    objetivo mucho mayor que el audio disponible. Si falta alguna duración, retorna target_ms.
+    """
+    total_ms = 0.0
+    previous_bpm = None
+    for track in playlist:
+        duration = track.get('duration')
+        if not duration or duration <= 0:
+            return target_ms
+        bpm = track.get('bpm')
+        stretch = bpm / previous_bpm if bpm and previous_bpm else 1.0
+        total_ms += duration * 1000 * max(1.0, stretch) + MIX_BUFFER_MARGIN_MS
+        previous_bpm = bpm
+    return min(target_ms, int(total_ms))
+
+def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, progress_callback=None) -> tuple[AudioBuffer, str]:
     """
     Crea una mezcla de audio a partir de una lista de pistas de análisis.
     playlist: Lista de diccionarios de resultados de análisis de audio.
     output_folder: Carpeta donde se guardará el archivo de mezcla final.
     mix_duration_minutes: Duración deseada de la mezcla final en minutos.
     progress_callback: Función para reportar el progreso (progreso_%, mensaje).
-    Retorna el AudioSegment de la mezcla final y el nombre del archivo.
+    Retorna el AudioBuffer de la mezcla final y el nombre del archivo, o (None, None) si falla.
+    Si el archivo de la primera pista no existe lanza FileNotFoundError (la mezcla no puede
+    empezar); si falta una pista posterior, la mezcla continúa sin ella.
     """
     if not playlist:
         mixing_logger.error("La playlist está vacía. No se puede crear la mezcla.")
@@ -201,22 +512,29 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
     mixing_logger.info(f"Creando mezcla para {len(playlist)} pistas. Duración objetivo: {mix_duration_minutes} minutos.")
     
     target_mix_duration_ms = mix_duration_minutes * 60 * 1000
-    final_mix = AudioSegment.empty()
-    
+
     # Cargar la primera pista
     current_track_info = playlist[0]
     try:
         current_track_path = current_track_info['filepath']
-        current_audio = AudioSegment.from_file(current_track_path)
-        
+        current_audio = _load_audio(current_track_path)
+
         # Ajustar el tempo de la primera pista si es necesario (ej. a un BPM inicial deseado, o simplemente al propio BPM)
         # Para la primera pista, la mantenemos como está o la ajustamos a su propio BPM detectado si es un objetivo.
         # Aquí la mantendremos tal cual y ajustaremos las siguientes.
-        
-        final_mix += current_audio[:min(current_audio.duration_recognizable, current_audio.duration_seconds * 1000)] # Añadir los primeros segundos o duración completa si es corta
-        
+
+        # La mezcla empieza con la primera pista completa; su formato (frecuencia y canales)
+        # es el de toda la mezcla
+        # El buffer se reserva con lo que puede ocupar la playlist, no con la duración pedida
+        final_mix = _MixBuffer(_max_mix_duration_ms(playlist, target_mix_duration_ms),
+                               current_audio.sr, current_audio.channels)
+        final_mix.append(current_audio.samples)
+
         mixing_logger.info(f"Añadida la primera pista: {current_track_info['filename']}")
 
+    except FileNotFoundError as e:
+        mixing_logger.error(f"No se encuentra la primera pista '{current_track_info.get('filename', 'N/A')}': {e}")
+        raise
     except Exception as e:
         error_msg = f"Error al cargar la primera pista '{current_track_info.get('filename', 'N/A')}': {e}"
         mixing_logger.error(error_msg, exc_info=True)
@@ -227,8 +545,19 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
     processed_tracks_count = 1
     total_tracks = len(playlist)
 
+    # La carga (decodificación) y el ajuste de tempo de la pista siguiente no dependen de la
+    # transición en curso: se adelantan en segundo plano mientras se mezcla la actual.
+    # La pista i+1 se ajusta al BPM de la pista i.
+    # Las duraciones de transición solo dependen del BPM de cada pista: se calculan una vez.
+    transition_ms_per_track = [get_bpm_adjusted_transition_duration(t['bpm']) for t in playlist]
+    prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mix_prefetch')
+    load_fut = None
+    if total_tracks > 1:
+        load_fut = prefetch_executor.submit(_load_and_stretch, playlist[1], playlist[0]['bpm'],
+                                            final_mix.sr, final_mix.channels)
+
     for i in range(total_tracks - 1):
-        if final_mix.duration_seconds * 1000 >= target_mix_duration_ms:
+        if final_mix.duration_ms >= target_mix_duration_ms:
             mixing_logger.info(f"Duración de mezcla objetivo ({mix_duration_minutes} min) alcanzada. Terminando mezcla.")
             break
         
@@ -241,27 +570,28 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
 
         mixing_logger.info(f"Preparando transición de '{current_track_info['filename']}' a '{next_track_info['filename']}'")
 
+        # Lanzar ya la carga de la pista que entrará en la siguiente transición
+        next_fut = load_fut
+        if i + 2 < total_tracks:
+            load_fut = prefetch_executor.submit(_load_and_stretch, playlist[i+2], next_track_info['bpm'],
+                                                final_mix.sr, final_mix.channels)
+
+        next_audio_original = None
         try:
-            next_audio_original = AudioSegment.from_file(next_track_info['filepath'])
-
-            # 1. Ajuste de Tempo para la pista entrante
-            next_audio_adjusted = adjust_tempo_librosa(
-                next_audio_original,
-                target_bpm=current_track_info['bpm'], # Intentar que la siguiente pista se adapte al BPM de la actual
-                current_bpm=next_track_info['bpm']
-            )
+            # 1. Pista entrante ya cargada y con el tempo ajustado al BPM de la actual
+            next_audio_original, next_audio_adjusted = next_fut.result()
             mixing_logger.debug(f"Tempo de '{next_track_info['filename']}' ajustado a {current_track_info['bpm']:.2f} BPM.")
 
             # 2. Determinar la duración de la transición
-            transition_duration_ms = get_bpm_adjusted_transition_duration(current_track_info['bpm'])
+            transition_duration_ms = transition_ms_per_track[i]
             mixing_logger.debug(f"Duración de transición calculada: {transition_duration_ms / 1000:.2f}s")
             
             # Asegurarse de que las pistas son lo suficientemente largas para la transición
             # y que la duración de la transición no excede la duración de la pista entrante o saliente
             # (evitando errores si las pistas son muy cortas)
-            actual_transition_duration = min(transition_duration_ms, 
-                                            current_audio.duration_seconds * 1000 - MIN_TRACK_MIX_END_MS,
-                                            next_audio_adjusted.duration_seconds * 1000 - MIN_TRACK_MIX_START_MS)
+            actual_transition_duration = min(transition_duration_ms,
+                                            current_audio.duration_ms - MIN_TRACK_MIX_END_MS,
+                                            next_audio_adjusted.duration_ms - MIN_TRACK_MIX_START_MS)
             
             # La duración mínima de una transición si las pistas son muy cortas, para evitar errores
             if actual_transition_duration < SHORT_TRANSITION_MS:
@@ -273,60 +603,26 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
             # 3. Preparar segmentos para la mezcla
             # Parte final de la pista actual que se mezclará
             # Asegurarse de no ir a un índice negativo
-            crossfade_out_start = max(0, len(current_audio) - actual_transition_duration)
-            segment_out = current_audio[crossfade_out_start:]
-
-            # Parte inicial de la siguiente pista que se mezclará
-            # Asegurarse de no ir a un índice más allá de la duración de la pista
-            crossfade_in_end = min(len(next_audio_adjusted), actual_transition_duration)
-            segment_in = next_audio_adjusted[:crossfade_in_end]
+            # (los tramos son vistas de las muestras, no copias)
+            crossfade_out_start = max(0, current_audio.duration_ms - actual_transition_duration)
+            segment_out = current_audio.slice_ms(crossfade_out_start)
 
+            # Parte de la siguiente pista que se mezclará, a partir de MIN_TRACK_MIX_START_MS.
             # Si la pista entrante no tiene suficiente duración para la transición,
-            # tomar lo que haya disponible.
-            if len(next_audio_adjusted) < MIN_TRACK_MIX_START_MS + actual_transition_duration:
-                segment_in = next_audio_adjusted[MIN_TRACK_MIX_START_MS:]
-            else:
-                segment_in = next_audio_adjusted[MIN_TRACK_MIX_START_MS : MIN_TRACK_MIX_START_MS + actual_transition_duration]
-
-            # 4. Aplicar fundidos y EQ (simulación)
-            # Fundido de salida para la pista actual
-            segment_out = segment_out.fade_out(actual_transition_duration)
-            # Opcional: EQ para el track saliente (ej. lowpass para cortar graves)
-            # segment_out = apply_eq(segment_out, 'lowpass', 150) # Corta graves
-
-            # Fundido de entrada para la siguiente pista
-            segment_in = segment_in.fade_in(actual_transition_duration)
-            # Opcional: EQ para el track entrante (ej. highpass para cortar agudos temporalmente)
-            # segment_in = apply_eq(segment_in, 'highpass', 5000) # Corta agudos
-
-            # 5. Realizar la mezcla (crossfade)
-            # Se usa el crossfade de pydub. Si los segmentos tienen diferentes duraciones
-            # pydub lo maneja, pero es mejor que sean del mismo tamaño para el crossfade.
-            # Nos aseguramos de que el crossfade ocurre sobre la duración calculada.
-            
-            # La parte final del 'final_mix' existente es el `current_audio` que debe salir.
-            # Removemos la duración de la transición del final_mix para superponer.
-            final_mix = final_mix[:-actual_transition_duration]
-            
-            # Superponer el segmento saliente y el entrante
-            # crossfade(self, other, duration, fade_by_proportion)
-            # Si se usa crossfade, pydub lo maneja.
-            # Aquí, lo que hacemos es adjuntar el resto del track actual sin la parte de crossfade_out.
-            # Y luego le añadimos el track entrante con un crossfade.
-            
-            # Opción 1: Superponer directamente con crossfade
-            mixed_segment = segment_out.overlay(segment_in)
-            final_mix += mixed_segment
-
-            # Opción 2 (más simple si el crossfade de pydub no funcionara bien):
-            # final_mix += segment_out.append(segment_in, crossfade=actual_transition_duration)
-            # Esta es la forma más directa de pydub de hacer crossfade.
-
-            # Añadir el resto de la pista entrante
-            # Empezar desde donde termina el segmento de entrada ya mezclado
-            remaining_next_audio = next_audio_adjusted[MIN_TRACK_MIX_START_MS + actual_transition_duration:]
-            final_mix += remaining_next_audio
-            
+            # slice_ms toma lo que haya disponible.
+            segment_in = next_audio_adjusted.slice_ms(MIN_TRACK_MIX_START_MS, MIN_TRACK_MIX_START_MS + actual_transition_duration)
+
+            # 4. Fundidos y mezcla (crossfade) en una sola pasada de NumPy.
+            mixed_samples = _crossfade_np(segment_out, segment_in, actual_transition_duration)
+
+            # 5. La parte final del 'final_mix' existente es el `current_audio` que debe salir:
+            # se sustituye por el tramo mezclado y se añade el resto de la pista entrante.
+            # El resto empieza donde termina el segmento de entrada ya mezclado.
+            remaining_next_audio = next_audio_adjusted.slice_ms(MIN_TRACK_MIX_START_MS + actual_transition_duration)
+            final_mix.rewind(mixed_samples.shape[0])
+            final_mix.append(mixed_samples)
+            final_mix.append(remaining_next_audio.samples)
+
             mixing_logger.info(f"Transición completada de '{current_track_info['filename']}' a '{next_track_info['filename']}'.")
 
             current_audio = next_audio_adjusted # La pista ajustada se convierte en la "actual" para la siguiente iteración
@@ -340,14 +636,19 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
                 progress_callback(90, f"Error en la transición. Intentando continuar. Error: {e}", True)
             # Si falla una transición, simplemente añadimos el resto de la pista actual y la siguiente completa
             # para no romper el bucle por completo.
-            final_mix += current_audio[len(current_audio) - 5000:] # Añadir últimos 5 segundos del actual
-            final_mix += next_audio_original # Añadir la siguiente pista sin ajustar
-            current_audio = next_audio_original # La original se convierte en la actual
+            final_mix.append(current_audio.slice_ms(max(0, current_audio.duration_ms - 5000)).samples) # Añadir últimos 5 segundos del actual
+            if next_audio_original is not None:
+                final_mix.append(next_audio_original.samples) # Añadir la siguiente pista sin ajustar
+                current_audio = next_audio_original # La original se convierte en la actual
+
+    # Si se alcanzó la duración objetivo antes de usar la pista adelantada, se descarta
+    prefetch_executor.shutdown(wait=False, cancel_futures=True)
 
-    # Asegurarse de que la mezcla final no exceda la duración deseada.
-    if final_mix.duration_seconds * 1000 > target_mix_duration_ms:
-        final_mix = final_mix[:target_mix_duration_ms]
+    # La mezcla final nunca excede la duración deseada: lo que sobraba se descartó al escribir.
+    if final_mix.truncated:
         mixing_logger.info(f"Recortada la mezcla final a la duración objetivo: {mix_duration_minutes} minutos.")
+    final_mix = final_mix.to_audio()
+    _normalize_peak(final_mix.samples)
 
     # Exportar la mezcla final
     output_filename = f"mixed_playlist_{int(time.time())}.mp3"
@@ -355,7 +656,7 @@ def create_mix(playlist: list, output_folder: str, mix_duration_minutes: int, pr
 
     try:
         mixing_logger.info(f"Exportando mezcla final a: {output_filepath}")
-        final_mix.export(output_filepath, format="mp3", bitrate="192k") # Calidad razonable
+        _export_mp3(final_mix, output_filepath)
         mixing_logger.info("Mezcla final exportada con éxito.")
         if progress_callback:
             progress_callback(100, "Mezcla completada.", False)
@@ -378,37 +679,33 @@ if __name__ == '__main__':
     os.makedirs(test_output_dir, exist_ok=True)
 
     # Crear archivos de audio dummy para la prueba (silencios con diferentes BPMs simulados)
-    mixing_logger.info("Generando archivos MP3 dummy para la prueba...")
-    test_track1_path = os.path.join(test_upload_dir, 'test_track1.mp3')
-    test_track2_path = os.path.join(test_upload_dir, 'test_track2.mp3')
-    test_track3_path = os.path.join(test_upload_dir, 'test_track3.mp3')
-    test_track4_path = os.path.join(test_upload_dir, 'test_track4.mp3')
-
-    # Generar segmentos de audio dummy con diferentes duraciones y 'BPM' simulados
-    # AudioSegment.silent(duration_ms, frame_rate=44100)
+    # Se escriben como WAV directamente con soundfile: no hace falta FFmpeg ni un subproceso por pista
+    mixing_logger.info("Generando archivos WAV dummy para la prueba...")
+    test_track1_path = os.path.join(test_upload_dir, 'test_track1.wav')
+    test_track2_path = os.path.join(test_upload_dir, 'test_track2.wav')
+    test_track3_path = os.path.join(test_upload_dir, 'test_track3.wav')
+    test_track4_path = os.path.join(test_upload_dir, 'test_track4.wav')
+
+    # Silencio estéreo de 30 segundos a 44.1 kHz
     # Necesitamos asignarles un 'bpm' para que adjust_tempo_librosa no falle.
-    dummy_audio1 = AudioSegment.silent(duration=30 * 1000, frame_rate=44100).set_channels(2)
-    dummy_audio2 = AudioSegment.silent(duration=30 * 1000, frame_rate=44100).set_channels(2)
-    dummy_audio3 = AudioSegment.silent(duration=30 * 1000, frame_rate=44100).set_channels(2)
-    dummy_audio4 = AudioSegment.silent(duration=30 * 1000, frame_rate=44100).set_channels(2)
+    silence = np.zeros((30 * 44100, 2), dtype=np.int16)
 
-    # Exportar a MP3. FFmpeg es necesario aquí.
     try:
-        dummy_audio1.export(test_track1_path, format="mp3")
-        dummy_audio2.export(test_track2_path, format="mp3")
-        dummy_audio3.export(test_track3_path, format="mp3")
-        dummy_audio4.export(test_track4_path, format="mp3")
-        mixing_logger.info("Archivos MP3 dummy generados.")
+        # Las cuatro pistas son idénticas: se escribe una y se copia a las demás
+        sf.write(test_track1_path, silence, 44100)
+        for test_track_path in (test_track2_path, test_track3_path, test_track4_path):
+            shutil.copy(test_track1_path, test_track_path)
+        mixing_logger.info("Archivos WAV dummy generados.")
     except Exception as e:
-        mixing_logger.error(f"Error al exportar archivos MP3 dummy. Asegúrate de que FFmpeg está instalado y en tu PATH. Error: {e}")
+        mixing_logger.error(f"Error al escribir los archivos WAV dummy. Error: {e}")
         sys.exit(1) # Salir si no podemos generar los archivos de prueba
 
     # Simular resultados de análisis (filepath es crucial)
     dummy_playlist = [
-        {'filename': 'test_track1.mp3', 'filepath': test_track1_path, 'bpm': 120.0, 'key': 'Cmaj', 'camelot_key': '8B', 'energy': 0.7, 'duration': 30.0},
-        {'filename': 'test_track2.mp3', 'filepath': test_track2_path, 'bpm': 125.0, 'key': 'Gmaj', 'camelot_key': '9B', 'energy': 0.8, 'duration': 30.0},
-        {'filename': 'test_track3.mp3', 'filepath': test_track3_path, 'bpm': 122.0, 'key': 'Dmaj', 'camelot_key': '10B', 'energy': 0.75, 'duration': 30.0},
-        {'filename': 'test_track4.mp3', 'filepath': test_track4_path, 'bpm': 128.0, 'key': 'Amin', 'camelot_key': '8A', 'energy': 0.85, 'duration': 30.0},
+        {'filename': 'test_track1.wav', 'filepath': test_track1_path, 'bpm': 120.0, 'key': 'Cmaj', 'camelot_key': '8B', 'energy': 0.7, 'duration': 30.0},
+        {'filename': 'test_track2.wav', 'filepath': test_track2_path, 'bpm': 125.0, 'key': 'Gmaj', 'camelot_key': '9B', 'energy': 0.8, 'duration': 30.0},
+        {'filename': 'test_track3.wav', 'filepath': test_track3_path, 'bpm': 122.0, 'key': 'Dmaj', 'camelot_key': '10B', 'energy': 0.75, 'duration': 30.0},
+        {'filename': 'test_track4.wav', 'filepath': test_track4_path, 'bpm': 128.0, 'key': 'Amin', 'camelot_key': '8A', 'energy': 0.85, 'duration': 30.0},
     ]
 
     # Callback de progreso para la prueba
@@ -438,7 +735,7 @@ if __name__ == '__main__':
     finally:
         # Limpiar archivos dummy y directorios temporales
         mixing_logger.info("Limpiando archivos temporales de prueba...")
-        for f_name in ["test_track1.mp3", "test_track2.mp3", "test_track3.mp3", "test_track4.mp3"]:
+        for f_name in ["test_track1.wav", "test_track2.wav", "test_track3.wav", "test_track4.wav"]:
             f_path = os.path.join(test_upload_dir, f_name)
             if os.path.exists(f_path):
                 try:
@@ -1,36 +1,69 @@
-import json
 import logging
+import os
 import sys
-import math
-import random # Para la selección aleatoria de la pista inicial
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from itertools import repeat
+# Misma caché en disco de numba que mixing_engine.py; debe fijarse antes de importar numba
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'dj_numba_cache'))
+import numpy as np
+
+from scipy.sparse import csr_matrix, vstack as sparse_vstack
+
+# numba compila el recorrido de las candidatas en find_next_track; sin él se usa NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # Configuración del logger para playlist_generation
 playlist_logger = logging.getLogger('playlist_generation_module')
-playlist_logger.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stderr)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-playlist_logger.addHandler(handler)
+playlist_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+# El handler se añade una sola vez aunque el módulo se reimporte, y los mensajes no se
+# propagan al logger raíz (se imprimirían dos veces)
+if not playlist_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    playlist_logger.addHandler(handler)
+playlist_logger.propagate = False
+
+# Hilos para comprobar en paralelo que los archivos existen (en bibliotecas montadas por red
+# cada stat es una petición al servidor)
+EXISTS_CHECK_WORKERS = 32
+
+# Búsqueda en haz (beam search): número de playlists parciales que se mantienen en cada paso.
+# Por defecto 1, el algoritmo voraz (find_next_track), que es el camino de producción; la
+# búsqueda en haz es opcional (DJ_BEAM_WIDTH=16, por ejemplo): mejora la puntuación media
+# menos de un 1 % y tarda de 4 a 9 veces más (ver README.md)
+BEAM_WIDTH = max(1, int(os.environ.get('DJ_BEAM_WIDTH', 1)))
+# Las transiciones del grafo de la búsqueda en haz, además de compatibles armónicamente,
+# cambian el BPM menos de este porcentaje
+BEAM_BPM_WINDOW = 0.08
+# Playlists que se construyen en paralelo (cada una desde una pista inicial distinta) para
+# quedarse con la mejor: una por núcleo, así el tiempo total es el de construir una sola.
+# Con 1 se construye una sola, en el propio proceso
+PLAYLIST_ATTEMPTS = os.cpu_count() or 1
+
+# Pool de procesos para construir las playlists candidatas (se crea al primer uso)
+_executor = None
+_executor_lock = threading.Lock()
 
 # Mapeo de claves Camelot (valores A son menores, B son mayores)
 # Los círculos concéntricos de la rueda de Camelot
+# Claves (número, modo): con claves enteras los menores se sobrescribían con los mayores
 CAMELOT_CIRCLE_OF_FIFTHS = {
     # Menores (A)
-    1: 'Abm', 2: 'Ebm', 3: 'Bbm', 4: 'Fm', 5: 'Cm', 6: 'Gm', 7: 'Dm', 8: 'Am', 9: 'Em', 10: 'Bm', 11: 'F#m', 12: 'Dbm',
+    (1, 'A'): 'Abm', (2, 'A'): 'Ebm', (3, 'A'): 'Bbm', (4, 'A'): 'Fm', (5, 'A'): 'Cm', (6, 'A'): 'Gm',
+    (7, 'A'): 'Dm', (8, 'A'): 'Am', (9, 'A'): 'Em', (10, 'A'): 'Bm', (11, 'A'): 'F#m', (12, 'A'): 'Dbm',
     # Mayores (B)
-    1: 'B', 2: 'F#', 3: 'Db', 4: 'Ab', 5: 'Eb', 6: 'Bb', 7: 'F', 8: 'C', 9: 'G', 10: 'D', 11: 'A', 12: 'E'
-}
-
-# Inverso para buscar el número Camelot dado la clave musical (ej: 'Cmaj' -> 8B)
-# Adaptado para que sea compatible con los resultados de audio_analysis.py
-CAMELOT_KEY_MAP = {
-    '8B': ('C', 'major'), '3B': ('C#', 'major'), '10B': ('D', 'major'), '5B': ('D#', 'major'),
-    '12B': ('E', 'major'), '7B': ('F', 'major'), '2B': ('F#', 'major'), '9B': ('G', 'major'),
-    '4B': ('G#', 'major'), '11B': ('A', 'major'), '6B': ('A#', 'major'), '1B': ('B', 'major'),
-
-    '5A': ('Cm', 'minor'), '12A': ('C#m', 'minor'), '7A': ('Dm', 'minor'), '2A': ('D#m', 'minor'),
-    '9A': ('Em', 'minor'), '4A': ('Fm', 'minor'), '11A': ('F#m', 'minor'), '6A': ('Gm', 'minor'),
-    '1A': ('G#m', 'minor'), '8A': ('Am', 'minor'), '3A': ('A#m', 'minor'), '10A': ('Bm', 'minor')
+    (1, 'B'): 'B', (2, 'B'): 'F#', (3, 'B'): 'Db', (4, 'B'): 'Ab', (5, 'B'): 'Eb', (6, 'B'): 'Bb',
+    (7, 'B'): 'F', (8, 'B'): 'C', (9, 'B'): 'G', (10, 'B'): 'D', (11, 'B'): 'A', (12, 'B'): 'E'
 }
 
 def get_camelot_number_and_mode(camelot_key: str) -> tuple[int, str]:
@@ -47,192 +80,546 @@ def get_camelot_number_and_mode(camelot_key: str) -> tuple[int, str]:
     except ValueError:
         return None, None
 
-def are_harmonically_compatible(key1_camelot: str, key2_camelot: str) -> bool:
+def parse_camelot(camelot_key: str) -> tuple[int, int] | None:
+    """
+    Convierte una clave Camelot en enteros (número, modo), con modo 0 = A y 1 = B.
+    Ej: '8B' -> (8, 1). Retorna None si la clave no es válida.
+    Se llama una sola vez por pista para que la comprobación de compatibilidad sea aritmética pura.
+    """
+    number, mode = get_camelot_number_and_mode(camelot_key)
+    if number is None or not 1 <= number <= 12 or mode not in ('A', 'B'):
+        return None
+    return number, 1 if mode == 'B' else 0
+
+def are_harmonically_compatible(key1: tuple[int, int], key2: tuple[int, int]) -> bool:
     """
-    Comprueba si dos claves Camelot son armónicamente compatibles.
+    Comprueba si dos claves Camelot, ya convertidas con parse_camelot, son armónicamente compatibles.
     Compatibles si:
     1. Son la misma clave (ej: 8B y 8B).
     2. Están adyacentes en el círculo de quintas (ej: 8B y 9B, 8B y 7B).
     3. Son relativas mayores/menores (mismo número, diferente modo, ej: 8A y 8B).
     """
-    num1, mode1 = get_camelot_number_and_mode(key1_camelot)
-    num2, mode2 = get_camelot_number_and_mode(key2_camelot)
-
-    if None in [num1, mode1, num2, mode2]:
-        playlist_logger.debug(f"Claves Camelot inválidas para compatibilidad: {key1_camelot}, {key2_camelot}")
-        return False
-
-    # 1. Misma clave
-    if num1 == num2 and mode1 == mode2:
-        return True
-
-    # 2. Adyacentes en el círculo de quintas (mismo modo, número +/- 1 o 12/1)
-    if mode1 == mode2:
-        if abs(num1 - num2) == 1 or \
-           (num1 == 1 and num2 == 12) or \
-           (num1 == 12 and num2 == 1):
-            return True
-
-    # 3. Relativas mayores/menores (mismo número, diferente modo)
-    if num1 == num2 and mode1 != mode2:
-        return True
-    
-    return False
-
-def calculate_bpm_difference_score(bpm1: float, bpm2: float) -> float:
+    num1, mode1 = key1
+    num2, mode2 = key2
+    # 1 y 3: mismo número (misma clave o relativa); 2: mismo modo y números a distancia 1 (o 12/1)
+    return num1 == num2 or (mode1 == mode2 and abs(num1 - num2) in (1, 11))
+
+# Índice 0..23 de cada clave de la rueda Camelot: (número - 1) * 2 + modo.
+# El índice 24 representa una clave desconocida o inválida (nunca compatible).
+CAMELOT_STATES = 24
+UNKNOWN_CAMELOT_INDEX = CAMELOT_STATES
+
+def camelot_index(key: tuple[int, int] | None) -> int:
+    """Convierte una clave (número, modo) de parse_camelot en su índice de la rueda (0-23, o 24 si es None)."""
+    if key is None:
+        return UNKNOWN_CAMELOT_INDEX
+    number, mode = key
+    return (number - 1) * 2 + mode
+
+# Tabla de compatibilidad armónica entre los 24 estados de la rueda (más el desconocido),
+# calculada una sola vez: cada comprobación es una lectura de memoria, sin ramas
+def _build_compat_table() -> np.ndarray:
+    keys = [(number, mode) for number in range(1, 13) for mode in (0, 1)]
+    table = np.zeros((CAMELOT_STATES + 1, CAMELOT_STATES + 1), dtype=np.uint8)
+    for key1 in keys:
+        for key2 in keys:
+            table[camelot_index(key1), camelot_index(key2)] = are_harmonically_compatible(key1, key2)
+    return table
+
+COMPAT = _build_compat_table()
+
+# Pesos de la puntuación de transición. Son constantes de módulo: numba las incrusta como
+# literales al compilar _transition_score
+HARMONIC_MATCH_SCORE = 5.0 # Puntuación alta para compatibilidad armónica
+HARMONIC_MISMATCH_SCORE = -2.0 # Penalización si no son compatibles
+BPM_WEIGHT = 3.0 # Peso medio para BPM
+ENERGY_WEIGHT = 1.0 # Peso bajo para energía
+
+def _transition_score(cam1_idx, cam2_idx, bpm1, bpm2, energy1, energy2, compat):
     """
-    Calcula una puntuación basada en la diferencia de BPMs.
-    Menor diferencia, mayor puntuación. Penaliza fuertemente grandes diferencias.
+    Puntuación de transición especializada para los pesos fijos de arriba, sobre valores ya
+    preparados: índices Camelot, BPM (0 si falta) y energía (NaN si falta).
+    En Python la usa _mean_transition_score; compilada con numba (_transition_score_jit) se llama
+    desde _best_next. Desde Python se usa la versión sin compilar: con pocas operaciones escalares,
+    el coste de llamar a numba es mayor que el propio cálculo.
     """
-    if bpm1 is None or bpm2 is None or bpm1 == 0 or bpm2 == 0:
-        return 0.0 # No se puede calcular si falta BPM
-
-    # Permite una pequeña tolerancia de BPM
-    if abs(bpm1 - bpm2) <= 2:
-        return 1.0 # Muy compatible en BPM
-
-    # Calcula el ratio, siempre >= 1
-    ratio = max(bpm1, bpm2) / min(bpm1, bpm2)
+    # 1. Compatibilidad armónica (muy importante)
+    score = HARMONIC_MATCH_SCORE if compat[cam1_idx, cam2_idx] else HARMONIC_MISMATCH_SCORE
+
+    # 2. Compatibilidad de BPM: máxima con hasta 2 BPM de diferencia; si no, decae con el ratio
+    # entre los BPM (10 es un factor de penalización arbitrario). Sin BPM no puntúa
+    if bpm1 == 0 or bpm2 == 0:
+        bpm_score = 0.0
+    elif abs(bpm1 - bpm2) <= 2:
+        bpm_score = 1.0
+    else:
+        bpm_score = 1.0 / (1.0 + (max(bpm1, bpm2) / min(bpm1, bpm2) - 1) * 10)
+    score += bpm_score * BPM_WEIGHT
 
-    # Una diferencia de 10% (ratio 1.1) ya empieza a ser considerable.
-    # Usar una función de decaimiento (ej. exponencial o lineal inverso)
-    # Ejemplo: 1 / (1 + (ratio - 1) * factor)
-    # Donde 'factor' controla la penalización.
-    bpm_score = 1.0 / (1.0 + (ratio - 1) * 10) # 10 es un factor de penalización arbitrario
-    return max(0.0, bpm_score) # Asegurar que la puntuación no sea negativa
+    # 3. Compatibilidad de Energía: decae con la diferencia (factor 5). Sin energía (NaN != NaN)
+    # no puntúa
+    if energy1 == energy1 and energy2 == energy2:
+        score += 1.0 / (1.0 + abs(energy1 - energy2) * 5) * ENERGY_WEIGHT
 
-def calculate_energy_difference_score(energy1: float, energy2: float) -> float:
+    # Ajustar puntuación para evitar negativos grandes
+    return max(score, 0.0)
+
+if njit is not None:
+    _transition_score_jit = njit(cache=True)(_transition_score)
+
+def _bits_to_indices(mask: int, n: int) -> np.ndarray:
+    """Índices de los bits a 1 de 'mask' (de n bits), en orden creciente."""
+    if mask.bit_count() <= 64:
+        # Pocos bits: aislar y borrar el bit más bajo en cada vuelta (mask & -mask)
+        indices = []
+        while mask:
+            lowest = mask & -mask
+            indices.append(lowest.bit_length() - 1)
+            mask ^= lowest
+        return np.array(indices, dtype=np.intp)
+    return np.flatnonzero(_bits_to_bool(mask, n))
+
+def _bits_to_bool(mask: int, n: int) -> np.ndarray:
+    """Máscara de bits 'mask' (de n bits) como array booleano de longitud n."""
+    bits = np.frombuffer(mask.to_bytes((n + 7) // 8, 'little'), dtype=np.uint8)
+    return np.unpackbits(bits, count=n, bitorder='little').view(bool)
+
+@dataclass
+class TrackArrays:
     """
-    Calcula una puntuación basada en la diferencia de energía.
-    Pistas con energía similar tienen mayor puntuación.
+    Columnas NumPy (estructura de arrays) con los datos de análisis de las pistas válidas,
+    construidas una sola vez por playlist para puntuar todas las candidatas de golpe.
+    cam_idx: índice de la clave en la rueda Camelot (ver camelot_index), para leer COMPAT.
+    durations_ms: duración de cada pista en milisegundos.
+    compat_masks: para cada índice Camelot, máscara de bits (int, bit i = pista i) de las pistas
+    compatibles con esa clave; las compatibles con la pista i son compat_masks[cam_idx[i]].
+    bpm_order: índices de las pistas ordenadas por BPM; sorted_bpms = bpms[bpm_order].
     """
-    if energy1 is None or energy2 is None:
-        return 0.0 # No se puede calcular si falta energía
-
-    diff = abs(energy1 - energy2)
-    # Normaliza la diferencia a un rango de 0 a 1 (asumiendo energía en [0, 1])
-    # energy_score = 1 - diff (si diff max es 1)
-    # O usar una función de decaimiento similar a BPM
-    energy_score = 1.0 / (1.0 + diff * 5) # 5 es un factor de penalización arbitrario
-    return max(0.0, energy_score)
-
-def score_transition(current_track: dict, next_track: dict) -> float:
+    cam_idx: np.ndarray
+    bpms: np.ndarray
+    energies: np.ndarray
+    durations_ms: np.ndarray
+    compat_masks: list
+    bpm_order: np.ndarray
+    sorted_bpms: np.ndarray
+
+    @classmethod
+    def from_tracks(cls, tracks: list) -> 'TrackArrays':
+        # Cada clave se interpreta una sola vez, al construir las columnas
+        cam_idx = np.array([camelot_index(parse_camelot(track.get('camelot_key'))) for track in tracks], dtype=np.intp)
+        # float64, igual que _transition_score, para que las puntuaciones (y los empates) coincidan
+        bpms = np.array([track['bpm'] for track in tracks], dtype=np.float64)
+        energies = np.array([track['energy'] for track in tracks], dtype=np.float64)
+        durations_ms = np.array([track['duration'] for track in tracks], dtype=np.float64) * 1000
+        return cls.from_columns(cam_idx, bpms, energies, durations_ms)
+
+    @classmethod
+    def from_columns(cls, cam_idx: np.ndarray, bpms: np.ndarray, energies: np.ndarray, durations_ms: np.ndarray) -> 'TrackArrays':
+        """Construye las columnas a partir de los arrays ya preparados (calcula compat_masks)."""
+        # Pistas de cada casilla de la rueda y, con COMPAT, las compatibles con cada casilla
+        cell_masks = [
+            int.from_bytes(np.packbits(cam_idx == cell, bitorder='little').tobytes(), 'little')
+            for cell in range(CAMELOT_STATES + 1)
+        ]
+        compat_masks = []
+        for cell in range(CAMELOT_STATES + 1):
+            mask = 0
+            for other in np.flatnonzero(COMPAT[cell]):
+                mask |= cell_masks[other]
+            compat_masks.append(mask)
+        bpm_order = np.argsort(bpms, kind='stable')
+        return cls(cam_idx, bpms, energies, durations_ms, compat_masks, bpm_order, bpms[bpm_order])
+
+def score_candidates(arrays: TrackArrays, current_idx: int, candidates=slice(None)) -> np.ndarray:
     """
-    Calcula una puntuación de compatibilidad para la transición entre dos pistas.
-    Una puntuación más alta indica una mejor transición.
+    Versión vectorizada de _transition_score: puntúa la transición desde la pista current_idx
+    hacia todas las pistas de 'candidates' (array de índices; por defecto, todas) a la vez.
     """
-    score = 0.0
+    # 1. Compatibilidad armónica: una lectura de la tabla COMPAT por candidata
+    compatible = COMPAT[arrays.cam_idx[current_idx], arrays.cam_idx[candidates]]
+    score = np.where(compatible, HARMONIC_MATCH_SCORE, HARMONIC_MISMATCH_SCORE)
 
-    # 1. Compatibilidad armónica (muy importante)
-    key1 = current_track.get('camelot_key')
-    key2 = next_track.get('camelot_key')
-
-    if key1 and key2 and are_harmonically_compatible(key1, key2):
-        score += 5.0 # Puntuación alta para compatibilidad armónica
-    else:
-        score -= 2.0 # Penalización si no son compatibles
+    # 2. Compatibilidad de BPM (mismas reglas que _transition_score)
+    bpm1, bpms = arrays.bpms[current_idx], arrays.bpms[candidates]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.maximum(bpm1, bpms) / np.minimum(bpm1, bpms)
+        bpm_score = np.where(np.abs(bpm1 - bpms) <= 2, 1.0, 1.0 / (1.0 + (ratio - 1) * 10))
+    bpm_score = np.where((bpm1 != 0) & (bpms != 0), bpm_score, 0.0)
+    score += bpm_score * BPM_WEIGHT
 
-    # 2. Compatibilidad de BPM (importante)
-    bpm1 = current_track.get('bpm')
-    bpm2 = next_track.get('bpm')
-    bpm_score = calculate_bpm_difference_score(bpm1, bpm2)
-    score += bpm_score * 3.0 # Peso medio para BPM
-
-    # 3. Compatibilidad de Energía (menos importante, pero ayuda a la fluidez)
-    energy1 = current_track.get('energy')
-    energy2 = next_track.get('energy')
-    energy_score = calculate_energy_difference_score(energy1, energy2)
-    score += energy_score * 1.0 # Peso bajo para energía
+    # 3. Compatibilidad de energía (mismas reglas que _transition_score)
+    score += 1.0 / (1.0 + np.abs(arrays.energies[current_idx] - arrays.energies[candidates]) * 5) * ENERGY_WEIGHT
 
     # Ajustar puntuación para evitar negativos grandes
-    return max(0.0, score)
-
+    return np.maximum(score, 0.0)
+
+if njit is not None:
+    @njit(cache=True)
+    def _bpm_score_jit(bpm1, bpm2):
+        """Puntuación de BPM de _transition_score, para _best_next (BPM 0 si falta)."""
+        if bpm1 == 0 or bpm2 == 0:
+            return 0.0
+        if abs(bpm1 - bpm2) <= 2:
+            return 1.0
+        return 1.0 / (1.0 + (max(bpm1, bpm2) / min(bpm1, bpm2) - 1) * 10)
+
+    @njit(cache=True)
+    def _best_next(current_idx, member, bpm_order, sorted_bpms, cam_idx, bpms, energies, compat, harmonic_bound, rng):
+        """
+        Igual que score_candidates + elegir la mejor entre las pistas con member[i] = True, pero
+        sin arrays temporales. Retorna el índice de la mejor (-1 si no hay ninguna).
+
+        Ramificación y poda por BPM: se recorren las pistas en orden de BPM hacia fuera desde el
+        BPM actual (dos punteros), siempre por el lado cuya siguiente pista tiene mejor
+        puntuación de BPM. Esa puntuación solo baja al alejarse, así que la cota
+        harmonic_bound + bpm_score * BPM_WEIGHT + ENERGY_WEIGHT de la siguiente pista acota
+        todas las que quedan: en cuanto es menor que la mejor puntuación, se termina.
+
+        Los empates se resuelven por muestreo de reservorio: la k-ésima pista empatada sustituye
+        a la elegida con probabilidad 1/k (elección uniforme, un número aleatorio por empate).
+        Sin fastmath, para obtener exactamente los mismos valores que NumPy.
+        """
+        best = -np.inf
+        best_idx = -1
+        ties = 0
+        cur_cam, bpm1, energy1 = cam_idx[current_idx], bpms[current_idx], energies[current_idx]
+        n = sorted_bpms.shape[0]
+        hi = np.searchsorted(sorted_bpms, bpm1)
+        lo = hi - 1
+        while lo >= 0 or hi < n:
+            lo_bpm_score = _bpm_score_jit(bpm1, sorted_bpms[lo]) if lo >= 0 else -1.0
+            hi_bpm_score = _bpm_score_jit(bpm1, sorted_bpms[hi]) if hi < n else -1.0
+            if hi_bpm_score >= lo_bpm_score:
+                j = hi
+                hi += 1
+                bound = harmonic_bound + hi_bpm_score * BPM_WEIGHT + ENERGY_WEIGHT
+            else:
+                j = lo
+                lo -= 1
+                bound = harmonic_bound + lo_bpm_score * BPM_WEIGHT + ENERGY_WEIGHT
+            if max(bound, 0.0) < best:
+                break
+            i = bpm_order[j]
+            if not member[i]:
+                continue
+            s = _transition_score_jit(cur_cam, cam_idx[i], bpm1, bpms[i], energy1, energies[i], compat)
+            if s > best:
+                best, best_idx, ties = s, i, 1
+            elif s == best:
+                ties += 1
+                if rng.random() * ties < 1.0:
+                    best_idx = i
+        return best_idx
+else:
+    _best_next = None
+
+def find_next_track(current_idx: int, active: int, arrays: TrackArrays, rng: np.random.Generator) -> int | None:
+    """
+    Encuentra la mejor pista siguiente entre las aún disponibles ('active': máscara de bits sobre
+    los índices de 'arrays') basándose en la puntuación de transición.
+    Retorna su índice, o None si no quedan pistas.
+
+    Solo se recorren las candidatas compatibles armónicamente con la pista actual
+    (active & arrays.compat_masks[...], sin mirar el resto de la biblioteca): una incompatible
+    puntúa como mucho -2 + 3 + 1 = 2 (ver los pesos) y una compatible al menos 5. Si no queda
+    ninguna compatible, se puntúan todas las activas. Con numba, además, las candidatas se
+    recorren por BPM y se descartan las que ya no pueden superar a la mejor (ver _best_next).
+    Los empates se deshacen al azar con 'rng'.
+    """
+    if not active:
+        return None
+
+    candidate_mask = active & arrays.compat_masks[arrays.cam_idx[current_idx]]
+    harmonic_bound = HARMONIC_MATCH_SCORE
+    if not candidate_mask:
+        candidate_mask = active
+        harmonic_bound = HARMONIC_MISMATCH_SCORE
+
+    if _best_next is not None:
+        member = _bits_to_bool(candidate_mask, len(arrays.bpms))
+        return int(_best_next(current_idx, member, arrays.bpm_order, arrays.sorted_bpms, arrays.cam_idx,
+                              arrays.bpms, arrays.energies, COMPAT, harmonic_bound, rng))
+
+    candidates = _bits_to_indices(candidate_mask, len(arrays.bpms))
+
+    scores = score_candidates(arrays, current_idx, candidates)
+    # Si hay un empate, elegir una al azar entre las mejores
+    return int(rng.choice(candidates[scores == scores.max()]))
+
+
+def _greedy_order(arrays: TrackArrays, start_idx: int, target_ms: float, rng: np.random.Generator) -> list:
+    """Playlist voraz: desde start_idx, añade cada vez la mejor pista siguiente (find_next_track)."""
+    order = [start_idx]
+    # Pistas aún no usadas (bit i = pista i): "quitar" una pista es borrar su bit
+    active = ((1 << len(arrays.bpms)) - 1) & ~(1 << start_idx)
+    duration_ms = arrays.durations_ms[start_idx]
+    while duration_ms < target_ms:
+        next_idx = find_next_track(order[-1], active, arrays, rng)
+        if next_idx is None:
+            playlist_logger.warning("No se pudo encontrar una pista compatible para la siguiente transición. Terminando generación de playlist.")
+            break
+        order.append(next_idx)
+        active &= ~(1 << next_idx)
+        duration_ms += arrays.durations_ms[next_idx]
+    return order
 
-def find_next_track(current_track: dict, remaining_tracks: list) -> dict | None:
+def build_transition_graph(arrays: TrackArrays, block_size: int = 1024) -> csr_matrix:
+    """
+    Grafo disperso (N x N) de las transiciones que explora la búsqueda en haz: pistas
+    compatibles armónicamente (COMPAT) cuyo BPM difiere menos de BEAM_BPM_WINDOW.
+    Se construye por bloques de filas para no crear la matriz densa N x N completa.
+    """
+    n = len(arrays.bpms)
+    blocks = []
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        mask = COMPAT[arrays.cam_idx[start:stop, None], arrays.cam_idx[None, :]].astype(bool)
+        bpm_from = arrays.bpms[start:stop, None]
+        mask &= np.abs(arrays.bpms[None, :] - bpm_from) < BEAM_BPM_WINDOW * bpm_from
+        mask[np.arange(stop - start), np.arange(start, stop)] = False # Sin bucles
+        blocks.append(csr_matrix(mask))
+    return sparse_vstack(blocks, format='csr')
+
+def _row_bitmasks(graph: csr_matrix) -> list:
+    """
+    Cada fila del grafo como máscara de bits en un int de Python (bit j = arista hacia j):
+    los conjuntos de pistas se combinan con & y ~ en una sola operación.
+    """
+    n = graph.shape[0]
+    row = np.zeros(n, dtype=bool)
+    masks = []
+    for i in range(n):
+        neighbors = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+        row[neighbors] = True
+        masks.append(int.from_bytes(np.packbits(row, bitorder='little').tobytes(), 'little'))
+        row[neighbors] = False
+    return masks
+
+@dataclass
+class _BeamState:
+    """Playlist parcial de la búsqueda en haz."""
+    order: list # Índices de las pistas, en orden
+    used: int # Máscara de bits de las pistas ya incluidas (bit i = pista i)
+    score: float # Suma de las puntuaciones de sus transiciones
+    duration_ms: float
+
+def _beam_search_order(arrays: TrackArrays, start_idx: int, target_ms: float, beam_width: int) -> list:
+    """
+    Playlist por búsqueda en haz: en cada paso se extiende cada playlist parcial con sus
+    beam_width mejores pistas siguientes (vecinas en build_transition_graph, o cualquier pista
+    no usada si no le queda ninguna) y se conservan las beam_width extensiones de mayor
+    puntuación acumulada. A diferencia del voraz, una transición algo peor ahora puede llevar a
+    una playlist mejor en conjunto, sin quedarse en "callejones sin salida" armónicos.
+    Entre las playlists que alcanzan target_ms se elige la de mejor puntuación media por transición.
+    """
+    n = len(arrays.bpms)
+    neighbor_masks = _row_bitmasks(build_transition_graph(arrays))
+    all_tracks = (1 << n) - 1
+    start = _BeamState([start_idx], 1 << start_idx, 0.0, arrays.durations_ms[start_idx])
+    # Igual que el voraz: si la pista inicial ya cubre la duración objetivo, basta con ella
+    if start.duration_ms >= target_ms:
+        return start.order
+    beam = [start]
+    finished = []
+
+    while beam:
+        # Candidatas de cada playlist parcial: (puntuación acumulada, índice en el haz, pista)
+        expansions = []
+        for k, state in enumerate(beam):
+            last = state.order[-1]
+            candidate_mask = neighbor_masks[last] & ~state.used
+            if not candidate_mask:
+                candidate_mask = all_tracks & ~state.used
+                if not candidate_mask: # Biblioteca agotada
+                    finished.append(state)
+                    continue
+            candidates = _bits_to_indices(candidate_mask, n)
+            scores = score_candidates(arrays, last, candidates)
+            if candidates.size > beam_width:
+                top = np.argpartition(scores, -beam_width)[-beam_width:]
+                candidates, scores = candidates[top], scores[top]
+            expansions.extend(zip((state.score + scores).tolist(), repeat(k), candidates.tolist()))
+
+        # Las beam_width mejores extensiones, sin repetir estados (misma última pista y mismas usadas)
+        expansions.sort(key=lambda expansion: expansion[0], reverse=True)
+        next_beam = []
+        seen = set()
+        for score, k, candidate in expansions:
+            if len(next_beam) >= beam_width:
+                break
+            parent = beam[k]
+            used = parent.used | (1 << candidate)
+            key = (candidate, used)
+            if key in seen:
+                continue
+            seen.add(key)
+            state = _BeamState(parent.order + [candidate], used, score, parent.duration_ms + arrays.durations_ms[candidate])
+            if state.duration_ms >= target_ms:
+                finished.append(state)
+            else:
+                next_beam.append(state)
+        beam = next_beam
+
+    best = max(finished, key=lambda state: state.score / max(len(state.order) - 1, 1))
+    return best.order
+
+def _build_order(arrays: TrackArrays, start_idx: int, seed: int, target_ms: float, beam_width: int) -> list:
+    """Construye una playlist (índices) desde start_idx con búsqueda en haz o, si beam_width es 1, voraz."""
+    if beam_width > 1:
+        return _beam_search_order(arrays, start_idx, target_ms, beam_width)
+    return _greedy_order(arrays, start_idx, target_ms, np.random.default_rng(seed))
+
+def _mean_transition_score(arrays: TrackArrays, order: list) -> float:
+    """Puntuación media por transición de una playlist; con ella se comparan playlists de distinta longitud."""
+    if len(order) < 2:
+        return 0.0
+    total = 0.0
+    for a, b in zip(order, order[1:]):
+        total += _transition_score(arrays.cam_idx[a], arrays.cam_idx[b], arrays.bpms[a], arrays.bpms[b],
+                                   arrays.energies[a], arrays.energies[b], COMPAT)
+    return total / (len(order) - 1)
+
+def _build_order_shared(shm_name: str, n: int, start_idx: int, seed: int, target_ms: float, beam_width: int) -> list:
     """
-    Encuentra la mejor pista siguiente de las restantes basándose en la puntuación de transición.
+    Tarea del pool de procesos: lee las columnas de la memoria compartida 'shm_name'
+    (matriz 4 x n float64: índice Camelot, BPM, energía, duración en ms) y construye una playlist.
     """
-    best_next_track = None
-    best_score = -float('inf')
-
-    for next_track in remaining_tracks:
-        # Asegurarse de que el track tiene los datos mínimos para el análisis
-        if not all(k in next_track and next_track[k] is not None for k in ['bpm', 'camelot_key', 'energy', 'filepath']):
-            playlist_logger.debug(f"Pista '{next_track.get('filename', 'N/A')}' omitida por datos incompletos.")
-            continue
-            
-        score = score_transition(current_track, next_track)
-        
-        # Preferir pistas no usadas recientemente si la puntuación es similar
-        # (Esto es una heurística simple, puede ser más complejo con historial)
-        if score > best_score:
-            best_score = score
-            best_next_track = next_track
-        elif score == best_score and best_next_track:
-            # Si hay un empate, elegir una al azar o usar alguna otra heurística
-            if random.choice([True, False]): # 50/50
-                best_next_track = next_track
-
-    return best_next_track
-
-
-def generate_playlist(analyzed_tracks: list, mix_duration_minutes: int = 30) -> list:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # Copia local (unos pocos KB): así no quedan vistas del bloque compartido al cerrarlo
+        columns = np.array(np.ndarray((4, n), dtype=np.float64, buffer=shm.buf))
+    finally:
+        shm.close()
+    arrays = TrackArrays.from_columns(columns[0].astype(np.intp), columns[1], columns[2], columns[3])
+    return _build_order(arrays, start_idx, seed, target_ms, beam_width)
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Retorna el pool de procesos para construir playlists en paralelo, con un proceso por núcleo.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # 'forkserver' en todas las plataformas que lo tienen: los hijos no heredan los hilos
+            # ni los locks del servidor (hacer fork de un proceso con hilos puede bloquearse)
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context('forkserver')
+            else:
+                mp_context = None # Windows: 'spawn'
+            max_workers = os.cpu_count() or 1
+            _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+            playlist_logger.info("Pool de generación de playlists creado con %d procesos.", max_workers)
+        return _executor
+
+def _reset_executor(broken: ProcessPoolExecutor):
+    """Descarta el pool si sigue siendo `broken` (murió un proceso); el siguiente get_executor() crea otro."""
+    global _executor
+    with _executor_lock:
+        if _executor is not broken:
+            return
+        _executor = None
+    playlist_logger.warning("El pool de generación de playlists se ha roto; se recreará.")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def _build_orders_parallel(arrays: TrackArrays, start_indices: list, seeds: list, target_ms: float, beam_width: int) -> list:
+    """
+    Construye una playlist por cada pista inicial en el pool de procesos. Las columnas se
+    publican una sola vez en memoria compartida, en lugar de enviar las pistas a cada tarea.
+    Si el pool falla, construye en este proceso solo la primera (repetirlas todas en serie
+    multiplicaría el tiempo de respuesta justo cuando el servidor va mal).
+    """
+    n = len(arrays.bpms)
+    shm = shared_memory.SharedMemory(create=True, size=4 * n * 8)
+    executor = None
+    try:
+        columns = np.ndarray((4, n), dtype=np.float64, buffer=shm.buf)
+        columns[0], columns[1], columns[2], columns[3] = arrays.cam_idx, arrays.bpms, arrays.energies, arrays.durations_ms
+        del columns
+        attempts = len(start_indices)
+        executor = get_executor()
+        return list(executor.map(_build_order_shared, repeat(shm.name, attempts), repeat(n, attempts),
+                                 start_indices, seeds, repeat(target_ms, attempts), repeat(beam_width, attempts)))
+    except (BrokenProcessPool, OSError) as e:
+        # Solo fallos del pool (murió un proceso, no se pudo crear): cualquier otro error es un
+        # fallo de la construcción, que se repetiría igual en este proceso, y se propaga
+        if isinstance(e, BrokenProcessPool):
+            _reset_executor(executor)
+        playlist_logger.warning("Fallo al construir playlists en paralelo (%s); se construye una en este proceso.", e)
+        return [_build_order(arrays, start_indices[0], seeds[0], target_ms, beam_width)]
+    finally:
+        shm.close()
+        shm.unlink()
+
+def generate_playlist(analyzed_tracks: list, mix_duration_minutes: int = 30, seed: int | None = None,
+                      beam_width: int = BEAM_WIDTH) -> list:
     """
     Genera una lista de reproducción optimizada para la mezcla.
     analyzed_tracks: Lista de diccionarios con los resultados del análisis de audio.
     mix_duration_minutes: Duración deseada de la mezcla en minutos.
+    seed: Semilla del generador aleatorio (pista inicial y desempates); None para una playlist distinta cada vez.
+    beam_width: Anchura de la búsqueda en haz (opcional); 1, por defecto, usa el algoritmo voraz (find_next_track).
     Retorna una lista de pistas ordenadas para la mezcla.
     """
-    playlist_logger.info(f"Iniciando generación de playlist para {len(analyzed_tracks)} pistas. Duración objetivo: {mix_duration_minutes} minutos.")
+    playlist_logger.info("Iniciando generación de playlist para %d pistas. Duración objetivo: %s minutos.", len(analyzed_tracks), mix_duration_minutes)
 
     if not analyzed_tracks:
         playlist_logger.warning("No hay pistas analizadas para generar una playlist.")
         return []
 
     # Filtrar pistas que tienen datos de análisis completos y válidos
-    valid_tracks = [
+    complete_tracks = [
         track for track in analyzed_tracks
         if all(k in track and track[k] is not None for k in ['bpm', 'camelot_key', 'energy', 'duration', 'filepath'])
         and track['duration'] > 0 # Asegurarse de que la duración no sea cero
-        and os.path.exists(track['filepath']) # Asegurarse de que el archivo existe
     ]
+    # Asegurarse de que el archivo existe: las comprobaciones (E/S bloqueante) se hacen en paralelo
+    valid_tracks = []
+    if complete_tracks:
+        with ThreadPoolExecutor(max_workers=min(EXISTS_CHECK_WORKERS, len(complete_tracks))) as executor:
+            exists = executor.map(os.path.exists, [track['filepath'] for track in complete_tracks])
+            valid_tracks = [track for track, found in zip(complete_tracks, exists) if found]
 
     if not valid_tracks:
         playlist_logger.error("No hay pistas válidas con datos de análisis completos para generar la playlist.")
         return []
 
-    playlist = []
-    remaining_tracks = list(valid_tracks) # Copia mutable
+    # Columnas NumPy con los datos de todas las pistas válidas, construidas una sola vez
+    arrays = TrackArrays.from_tracks(valid_tracks)
 
-    # Elegir una pista inicial aleatoria
-    current_track = random.choice(remaining_tracks)
-    playlist.append(current_track)
-    remaining_tracks.remove(current_track)
-    playlist_logger.info(f"Pista inicial seleccionada: {current_track['filename']} (BPM: {current_track['bpm']}, Key: {current_track['camelot_key']})")
+    # Un único generador aleatorio para toda la generación
+    rng = np.random.default_rng(seed)
 
-    current_mix_duration_ms = current_track['duration'] * 1000 # Convertir a milisegundos
+    # Varias playlists, cada una desde una pista inicial aleatoria distinta y con su propia
+    # semilla; se devuelve la de mejor puntuación media por transición
+    attempts = min(PLAYLIST_ATTEMPTS, len(valid_tracks))
+    start_indices = rng.choice(len(valid_tracks), size=attempts, replace=False).tolist()
+    seeds = rng.integers(2**32, size=attempts).tolist()
     target_mix_duration_ms = mix_duration_minutes * 60 * 1000
+    if attempts > 1:
+        orders = _build_orders_parallel(arrays, start_indices, seeds, target_mix_duration_ms, beam_width)
+    else:
+        orders = [_build_order(arrays, start_indices[0], seeds[0], target_mix_duration_ms, beam_width)]
+    order = max(orders, key=lambda order: _mean_transition_score(arrays, order))
 
-    while remaining_tracks and current_mix_duration_ms < target_mix_duration_ms:
-        next_track = find_next_track(current_track, remaining_tracks)
+    start_track = valid_tracks[order[0]]
+    playlist_logger.info("Pista inicial seleccionada: %s (BPM: %s, Key: %s)", start_track['filename'], start_track['bpm'], start_track['camelot_key'])
+
+    playlist = [valid_tracks[i] for i in order]
+    current_mix_duration_ms = 0.0
+    for next_track in playlist:
+        current_mix_duration_ms += next_track['duration'] * 1000
+        # Detalle por pista solo en DEBUG (el formateo con % se hace después de comprobar el nivel);
+        # en INFO basta el resumen del final
+        playlist_logger.debug("Añadida a playlist: %s (BPM: %s, Key: %s). Duración acumulada: %.2f min.",
+                              next_track['filename'], next_track['bpm'], next_track['camelot_key'], current_mix_duration_ms / 60000)
 
-        if next_track:
-            playlist.append(next_track)
-            remaining_tracks.remove(next_track)
-            current_track = next_track
-            current_mix_duration_ms += next_track['duration'] * 1000
-            playlist_logger.info(f"Añadida a playlist: {next_track['filename']} (BPM: {next_track['bpm']}, Key: {next_track['camelot_key']}). Duración acumulada: {current_mix_duration_ms / 60000:.2f} min.")
-        else:
-            playlist_logger.warning("No se pudo encontrar una pista compatible para la siguiente transición. Terminando generación de playlist.")
-            break
-            
     # Si la playlist es demasiado corta, podemos intentar añadir más pistas aleatoriamente
     # o repetir pistas que ya están, aunque no sea lo ideal.
     # Por simplicidad, si no hay más pistas compatibles y la duración objetivo no se ha alcanzado,
     # simplemente terminamos. Una implementación más avanzada podría buscar pistas "menos compatibles"
     # como último recurso.
 
-    playlist_logger.info(f"Generación de playlist finalizada. Número de pistas: {len(playlist)}. Duración total estimada: {current_mix_duration_ms / 60000:.2f} minutos.")
+    playlist_logger.info("Generación de playlist finalizada. Número de pistas: %d. Duración total estimada: %.2f minutos.", len(playlist), current_mix_duration_ms / 60000)
     return playlist
 
 if __name__ == '__main__':